@@ -3,7 +3,7 @@
 # Build pyspy binaries with pyinstaller
 
 # Usage:
-#   ./build.sh _WITH_GEOIP _WITH_HTTPD _WITH_FLASK _WITH_BUNDLE
+#   ./build.sh _WITH_GEOIP _WITH_HTTPD _WITH_FLASK _WITH_BUNDLE _WITH_NUMPY
 
 # Required: Python 3.7.3+, sysv-ipc, pyinstaller
 #   python3 -m venv venv && . venv/bin/activate && \
@@ -15,7 +15,7 @@ PYINSTALLER=1
 PACK=1
 REQS="$(cut -d= -f1 requirements.txt 2>/dev/null)"
 ARGS="--hidden-import sysv_ipc"
-OPTS="_WITH_GEOIP _WITH_HTTPD _WITH_FLASK _WITH_BUNDLE"
+OPTS="_WITH_GEOIP _WITH_HTTPD _WITH_FLASK _WITH_BUNDLE _WITH_NUMPY"
 PACKFILES="../spy.conf spy ../webspy"
 
 if [ ! -s requirements.txt ] || [ -z "$REQS" ]; then
@@ -35,6 +35,10 @@ for a in "$@"; do
     ARGS="--hidden-import flask"
     REQS="$REQS flask"
   fi
+  if echo "$a" | grep -q "_WITH_NUMPY"; then
+    ARGS="$ARGS --hidden-import numpy"
+    REQS="$REQS numpy"
+  fi
   if echo "$a" | grep -q "_WITH_BUNDLE"; then
     echo "build: including webspy dir in pyinstaller bundle..."
     ARGS=" $ARGS --add-data webspy:./webspy "
@@ -134,3 +138,4 @@ sed -i "s/^\(_WITH_GEOIP\) *= *.*$/\1 = False/" "$PYSRC"
 sed -i "s/^\(_WITH_HTTPD\) *= *.*$/\1 = True/" "$PYSRC"
 sed -i "s/^\(_WITH_FLASK\) *= *.*$/\1 = True/" "$PYSRC"
 sed -i "s/^\(_WITH_BUNDLE\) *= *.*$/\1 = False/" "$PYSRC"
+sed -i "s/^\(_WITH_NUMPY\) *= *.*$/\1 = False/" "$PYSRC"
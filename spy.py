@@ -21,9 +21,14 @@ import configparser
 import os
 import sys
 import socket
-import calendar
+import ipaddress
+import json
+import mmap
 import collections
+import concurrent.futures
+import copy
 import subprocess
+import threading
 import sysv_ipc
 
 
@@ -31,20 +36,26 @@ _WITH_GEOIP = False
 _WITH_HTTPD = True
 _WITH_FLASK = True
 _WITH_BUNDLE = False
+_WITH_NUMPY = False
 
 PYINSTALLER = False
 
 if _WITH_HTTPD:
+    import gzip
     import http.server
-    import socketserver
-    import threading
+    import urllib.parse
 
 if _WITH_FLASK:
     import flask
 
 if _WITH_GEOIP:
+    import geoip2.database
+    import geoip2.errors
     import geoip2.webservice
 
+if _WITH_NUMPY:
+    import numpy
+
 if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
     PYINSTALLER = True
 
@@ -58,16 +69,12 @@ if PYINSTALLER:
 SCRIPT = os.path.basename(sys.argv[0])
 SCRIPT_NAME = os.path.splitext(SCRIPT)[0]
 SCRIPT_DIR = os.path.dirname(SCRIPT_PATH)
-UPLOADS = DOWNLOADS = 0
-TOTAL_UP_SPEED = TOTAL_DN_SPEED = 0
-ONLINEUSERS = BROWSERS = IDLERS = 0
 SHOWALL = 0
-GEOIP2_BUF = {}
-GEOIP2_CLIENT = None
 
 CLI_MODE = 1
 HTTPD_MODE = 0
 FLASK_MODE = 0
+RECORD_MODE = 0
 FLASK_PROXY= False
 CLI_SEARCH = 0  # search username in list, not that usefull - disabled by default
 
@@ -78,18 +85,20 @@ if _WITH_HTTPD:
     SPY_VERSTR += '-httpd'
 if _WITH_FLASK:
     SPY_VERSTR += '-flask'
+if _WITH_NUMPY:
+    SPY_VERSTR += '-numpy'
 
 
 # handle args
 ##############
 
 if '-h' in sys.argv or '--help' in sys.argv:
-    print(f'./{SCRIPT_NAME} [--cli|--httpd|--flask|--web]')
+    print(f'./{SCRIPT_NAME} [--cli|--httpd|--flask|--web|--record]')
     sys.exit(0)
 elif '-v' in sys.argv or '--version' in sys.argv:
     print(SPY_VERSTR)
     sys.exit(0)
-elif len(sys.argv) > 1 and len(sys.argv[1]) in [5, 7]:
+elif len(sys.argv) > 1 and len(sys.argv[1]) in [5, 7, 8]:
     if '--cli' in sys.argv or '--spy' in sys.argv:
         CLI_MODE = 1
         print('No need specify spy/cli mode as its the default')
@@ -99,6 +108,9 @@ elif len(sys.argv) > 1 and len(sys.argv[1]) in [5, 7]:
     elif _WITH_FLASK and ('--web' in sys.argv or '--flask' in sys.argv):
         CLI_MODE = 0
         FLASK_MODE = 1
+    elif sys.argv[1] == '--record':
+        CLI_MODE = 0
+        RECORD_MODE = 1
     else:
         sys.exit(0)
 else:
@@ -149,24 +161,52 @@ try:
     httpd_port = config.getint('WEB', 'httpd_port', fallback=8080)
     flask_host = config.get('WEB', 'flask_host', fallback='localhost')
     flask_port = config.getint('WEB', 'flask_port', fallback=5000)
+    snapshot_max_age = config.getfloat('WEB', 'snapshot_max_age', fallback=0.25)
+    metrics_users = config.getboolean('WEB', 'metrics_users', fallback=False)
+    sample_rate = config.getfloat('DEFAULT', 'sample_rate', fallback=2)
+    userfile_index = config.getfloat('DEFAULT', 'userfile_index', fallback=0)
     geoip2_accountid = config['GEOIP']['geoip2_accountid']
     geoip2_licensekey = config['GEOIP']['geoip2_licensekey']
-    geoip2_proxy = config.get('GEOIP', 'geoip_proxy', fallback=None)
+    geoip2_proxy = config.get('GEOIP', 'geoip2_proxy', fallback=None)
     geoip2_enable = config.getboolean('GEOIP', 'geoip2_enable', fallback=False)
-except (KeyError, configparser.InterpolationError) as conf_err:
+    geoip2_mmdb = config.get('GEOIP', 'geoip2_mmdb', fallback='')
+    geoip2_cachefile = config.get('GEOIP', 'geoip2_cachefile', fallback='')
+    record_enable = config.getboolean('RECORD', 'record_enable', fallback=False)
+    record_file = config.get('RECORD', 'record_file', fallback='spy.rec')
+    record_max = config.getint('RECORD', 'record_max', fallback=86400)
+    record_interval = config.getfloat('RECORD', 'record_interval', fallback=1)
+    record_sessions = config.getint('RECORD', 'record_sessions', fallback=0)
+    # one site per [SITE:<name>] section, options missing there are taken from DEFAULT.
+    # without site sections there is a single site from DEFAULT
+    site_configs = [
+        (section[5:], config.get(section, 'glrootpath'), config.get(section, 'ipc_key', fallback=''), config.getint(section, 'maxusers', fallback=20))
+        for section in config.sections() if section.startswith('SITE:')
+    ]
+    if not site_configs:
+        site_name = config.get('DEFAULT', 'site_name', fallback='') or os.path.basename(glrootpath.rstrip('/')) or 'glftpd'
+        site_configs = [(site_name, glrootpath, ipc_key, maxusers)]
+except (KeyError, ValueError, configparser.InterpolationError) as conf_err:
     print(f'Error: check config file\n{conf_err}')
     sys.exit(1)
 
-MAXUSERS = maxusers if maxusers else 0
 THRESHOLD = threshold if threshold else 0
 IDLE_BARRIER = idle_barrier if idle_barrier else 0
 GEOIP2_ENABLE = geoip2_enable if geoip2_enable else False
 REFRESH = refresh if refresh else 1
+SNAPSHOT_MAX_AGE = snapshot_max_age if snapshot_max_age else 0
+METRICS_USERS = metrics_users if metrics_users else False
+SAMPLE_RATE = sample_rate if sample_rate and sample_rate > 0 else 0
+USERFILE_INDEX = userfile_index if userfile_index and userfile_index > 0 else 0
 DEBUG = debug if debug else 0
+RECORD_ENABLE = record_enable if record_enable else False
+RECORD_MAX = record_max if record_max and record_max > 0 else 86400
+RECORD_INTERVAL = record_interval if record_interval and record_interval > 0 else 1
+RECORD_SESSIONS = min(record_sessions, 1024) if record_sessions and record_sessions > 0 else 0
 
 if CLI_MODE:
+    import codecs
+    import selectors
     import signal
-    import select
     import tty
     TTY_SETTINGS = tty.tcgetattr(sys.stdin)
 
@@ -195,15 +235,10 @@ if PYINSTALLER:
 # glftpd data
 ##############
 
-# shm and struct (default ipc_key: 0x0000dead=57005)
-IPC_KEY = ipc_key if ipc_key else "0x0000DEAD"
-KEY = int(IPC_KEY, 16)
+# shm and struct (default ipc_key: 0x0000dead=57005), key per site see Site
 NULL_CHAR = b'\x00'
-if DEBUG > 3:
-    print(
-        f'DEBUG:\tIPC_KEY={IPC_KEY} KEY={KEY} sysv_ipc.SHM_RDONLY={sysv_ipc.SHM_RDONLY}\n',
-        f'\tfmt = {KEY:#010x}', id(KEY)
-    )
+RESOLVING = "resolving\u2026"
+SHM_DEST = 0o1000   # shm_perm.mode flag, set when segment is marked for removal
 
 # converted from structonline.h and arranged like struct_ONLINE:
 # tag(64s), username(24s), status(h) <...> procid(i)
@@ -226,50 +261,25 @@ struct_ONLINE = collections.namedtuple(
     bytes_txfer1 bytes_txfer2     \
     procid'
 )
-
-# set global var with gl's version
-GL_VER = ""
-try:
-    glbin_popt = dict(stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    with subprocess.Popen(f'{glrootpath}/bin/glftpd', **glbin_popt) as glbin_proc:
-        glbin_out, glbin_err = glbin_proc.communicate()
-        if not glbin_err:
-            GL_VER = glbin_out.decode().split('\n', maxsplit=1)[0]
-except FileNotFoundError:
-    pass
-
-# set global var with groupfile contents (/etc/group)
-GROUPFILE = None
-try:
-    with open(f'{glrootpath}/etc/group', 'r', encoding='utf-8', errors='ignore') as grp_file:
-        GROUPFILE = grp_file.readlines()
-except IOError:
-    pass
-
-# set global var for users dir (/ftp-data/users)
-USERS_DIR = None
-for gl_udir_name in [f"{glrootpath}/ftp-data/users", "/ftp-data/users"]:
-    if os.path.isdir(gl_udir_name):
-        USERS_DIR=gl_udir_name
-        break
-
-# set global var for totalusers, use spy.conf or glftpd.conf's maxusers
-glconf_maxusers = 0
-for glconf_fn in [f'{glrootpath}/../glftpd.conf', f'{glrootpath}/glftpd.conf', '/etc/glftpd.conf']:
-    try:
-        with open(glconf_fn, 'r', encoding='utf-8', errors='ignore') as glconf_obj:
-            for glconf_line in glconf_obj.readlines():
-                if re.search(r'^max_users \d', glconf_line):
-                    for mu_cnt in glconf_line.split()[1:]:
-                        glconf_maxusers += int(mu_cnt)
-                    break
-    except IOError:
-        pass
-TOTALUSERS = 0
-if MAXUSERS == -1 and glconf_maxusers > 0:
-    TOTALUSERS = glconf_maxusers
-else:
-    TOTALUSERS = maxusers
+STRUCT_SIZE = struct.calcsize(STRUCT_FORMAT)
+
+# numpy dtype with same layout as STRUCT_FORMAT, offsets (incl padding) come from struct
+ONLINE_DTYPE = None
+if _WITH_NUMPY:
+    struct_codes = []
+    for struct_token in STRUCT_FORMAT.split():
+        if struct_token.endswith('s'):
+            struct_codes.append(struct_token)
+        else:
+            struct_codes += [struct_token[-1]] * int(struct_token[:-1] or 1)
+    ONLINE_DTYPE = numpy.dtype({
+        'names': list(struct_ONLINE._fields),
+        'formats': [f'S{c[:-1]}' if c.endswith('s') else c for c in struct_codes],
+        'offsets': [
+            struct.calcsize(' '.join(struct_codes[:i+1])) - struct.calcsize(c) for i, c in enumerate(struct_codes)
+        ],
+        'itemsize': STRUCT_SIZE
+    })
 
 HELP_TEXT  = """
   Main screen:
@@ -290,52 +300,94 @@ HELP_TEXT  = """
 # geoip
 ########
 
-if _WITH_GEOIP and GEOIP2_ENABLE:
-    GEOIP2_CLIENT = geoip2.webservice.Client(
-        geoip2_accountid,
-        geoip2_licensekey,
-        host='geolite.info',
-        proxy=geoip2_proxy if geoip2_proxy not in [None, 'None'] else None
-    )
+# local db (offline) or web service, see GEOIP_CACHE
+GEOIP2_MMDB = os.path.join(SCRIPT_DIR, geoip2_mmdb) if geoip2_mmdb else None
+GEOIP2_CACHEFILE = os.path.join(SCRIPT_DIR, geoip2_cachefile) if geoip2_cachefile not in ['', 'None'] else None
+
+
+# recorder
+###########
+
+# ring file with a record per snapshot, see RECORDER
+RECORD_FILE = os.path.join(SCRIPT_DIR, record_file) if record_file not in ['', 'None'] else None
+if RECORD_MODE and not RECORD_FILE:
+    print('Error: --record needs record_file')
+    sys.exit(1)
 
 
 # classes
 ###########
 
+class LruDict(collections.OrderedDict):
+    """ OrderedDict with at most 'size' entries, a key that is set becomes newest and
+        the oldest ones are dropped. callers move_to_end() keys on hits """
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+        self.evictions = 0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.size:
+            self.popitem(last=False)
+            self.evictions += 1
+
+
 class User:
-    """ user struct as namedtuple, calc stats """
-    uploads = UPLOADS
-    downloads = DOWNLOADS
-    total = 0
-    total_up_speed = TOTAL_UP_SPEED
-    total_dn_speed = TOTAL_DN_SPEED
-    total_speed = 0
-    browsers = BROWSERS
-    idlers = IDLERS
-    geoip2_client = GEOIP2_CLIENT if GEOIP2_CLIENT else None
-    geoip2_shown_err = False
+    """ user struct as slotted record, strings from tuple are decoded on first use """
+    __slots__ = (
+        'user_tuple', 'slot', 'bytes_xfer', 'bytes_txfer', 'name', 'group', 'online',
+        'mb_xfered', 'addr', 'ip', 'traf_dir', 'filename', 'session', 'decoded', 'site',
+        # set by set_stats()
+        'filesize', 'iso_code', 'userfile', 'speed', 'speed_avg', 'speed_ewma',
+        'pct', 'eta', 'p_bar', 'fmt_status',
+    )
     tls_mode = [
         'None',       # no ssl
         'Control',    # ssl on control
         'Both'        # ssl on control and data
     ]
 
-    def __init__(self, user_tuple, online=0):
+    def __init__(self, user_tuple, online=0, bytes_xfer=None, bytes_txfer=None, slot=None, site=None):
         self.user_tuple = user_tuple
+        self.slot = slot
+        self.site = site
+        self.decoded = {}
+        self.bytes_xfer = bytes_xfer if bytes_xfer is not None else user_tuple.bytes_xfer2 * pow(2, 32) + user_tuple.bytes_xfer1
+        self.bytes_txfer = bytes_txfer if bytes_txfer is not None else user_tuple.bytes_txfer2 * pow(2, 32) + user_tuple.bytes_txfer1
         self.name = self.get_name()
         self.group = self.get_group()
         self.online = online
         self.mb_xfered = self.get_mb_xfered()
         (self.addr, self.ip) =  self.get_ip()
+        self.traf_dir = self.calc_traf_dir()
+        self.filename = self.get_filename()
+        self.session = (user_tuple.procid, user_tuple.tstart_tv_sec, user_tuple.tstart_tv_usec)
+        # set on copies by set_stats(), as lookups finish
+        self.filesize = 0
+        self.iso_code = None
+        self.userfile = None
+        # set on every snapshot by set_stats()
+        self.speed = self.speed_avg = self.speed_ewma = self.pct = 0
+        self.eta = None
+        self.p_bar = self.fmt_status = ""
+
+    def __copy__(self):
+        """ shallow copy for set_stats(), shares decoded strings """
+        user = User.__new__(User)
+        for attr in User.__slots__:
+            setattr(user, attr, getattr(self, attr))
+        return user
 
     def get_name(self) -> str:
         """ get username from tuple """
-        return self.user_tuple.username.split(NULL_CHAR, 1)[0].decode()
+        return self.get('username')
 
     def get_group(self) -> str:
-        """ get group name using gid from tuple """
+        """ get group name using gid from tuple, from groupfile of user's site """
         if self.user_tuple.groupid >= 0:
-            return get_group(self.user_tuple.groupid)
+            return self.site.get_group(self.user_tuple.groupid) if self.site else get_group(self.user_tuple.groupid)
         return ""
 
     def get_ip(self) -> tuple:
@@ -351,73 +403,1564 @@ class User:
             elif '.' not in addr:
                 ip = '127.0.0.1' if addr == 'localhost' else '0.0.0.0'
             else:
-                try:
-                    ip = socket.gethostbyname(addr)
-                except OSError:
-                    pass
+                ip = HOST_RESOLVER.get(addr) or RESOLVING
         return (addr, ip)
 
     def get_bytes_xfer(self) -> int:
-        """ bytes_xfer: convert 2 uint32 to uint64 """
-        return self.get('bytes_xfer2') * pow(2, 32) + self.get('bytes_xfer1')
+        """ bytes_xfer: 2 uint32 converted to uint64 on init """
+        return self.bytes_xfer
 
     def get_bytes_txfer(self) -> int:
-        """ bytes_txfer: convert 2 uint32 to uint64 """
-        return self.get('bytes_txfer2') * pow(2, 32) + self.get('bytes_txfer1')
+        """ bytes_txfer: 2 uint32 converted to uint64 on init """
+        return self.bytes_txfer
 
     def get_mb_xfered(self) -> int:
         """ convert tranfered bytes to mb """
         return (abs(self.get_bytes_xfer() / 1024 / 1024)) if self.get_bytes_xfer() else 0
 
-    def get_traf_dir(self) -> str:
-        """ traffic direction """
+    def get_session(self) -> tuple:
+        """ key of current transfer session """
+        return self.session
+
+    def calc_traf_dir(self) -> str:
+        """ traffic direction from status, on init """
         if self.get_bytes_xfer():
             if self.get('status')[:4] == 'RETR':
                 return "Dn"
             if self.get('status')[:4] == 'STOR' or self.get('status')[:4] == 'APPE':
                 return "Up"
+        return None
+
+    def get_traf_dir(self) -> str:
+        """ traffic direction """
+        return self.traf_dir
+
+    def get_filename(self) -> str:
+        """ filename being transferred from status, on init """
+        status = self.get('status')
+        if self.traf_dir and len(status) > 4 and not status[4:].startswith('-'):
+            return status[5:]
+        return ""
 
     def get(self, attr):
-        """ get attributes from tuple """
+        """ get attributes from tuple, bytes are decoded once and memoized """
+        if attr in self.decoded:
+            return self.decoded[attr]
         r = getattr(self.user_tuple, attr)
-        if DEBUG > 1:
-            print(f'DEBUG: user.get() attr={attr} type={type(r)}')
         if isinstance(r, bytes):
-            return r.split(NULL_CHAR, 1)[0].decode()
+            if DEBUG > 1:
+                print(f'DEBUG: user.get() decode attr={attr}')
+            r = self.decoded[attr] = r.split(NULL_CHAR, 1)[0].decode()
         return r
 
 
+# summed stats of all users in a snapshot, immutable so it can be shared by threads
+Totals = collections.namedtuple(
+    'Totals',
+    'uploads downloads total total_up_speed total_dn_speed total_speed idlers browsers onlineusers',
+    defaults=(0, 0, 0, 0, 0, 0, 0, 0, 0)
+)
+
+# users from one read of shm, changed is set of slots that differ from previous read (of
+# (site name, slot) with multiple sites), sites has Totals per site name
+Snapshot = collections.namedtuple('Snapshot', 'users changed totals version time sites', defaults=(Totals(), 0, 0, None))
+
+
+class ShmReader:
+    """ long-lived read-only attachment to glftpd's ONLINE shm segment,
+        keeps previous image and user objects per slot to skip unchanged logins """
+    def __init__(self, key, site=None):
+        self.key = key
+        self.site = site
+        self.memory = None
+        self.view = None
+        self.prev = None
+        self.users = {}
+        self.read_time = 0      # secs the last snapshot() took
+        # reentrant, read() holds it when attach() detaches a stale segment
+        self.lock = threading.RLock()
+
+    def attach(self):
+        """ attach to segment and map it as memoryview (no copy) """
+        self.detach()
+        try:
+            self.memory = sysv_ipc.SharedMemory(self.key, flags=sysv_ipc.SHM_RDONLY, mode=0)
+        except sysv_ipc.ExistentialError as exc:
+            raise RuntimeError('No logged in users found') from exc
+        try:
+            view = memoryview(self.memory)
+            # only use whole structs
+            self.view = view[:len(view) - len(view) % STRUCT_SIZE]
+        except TypeError:
+            # sysv_ipc < 1.0 has no buffer protocol, fall back to read()
+            self.view = None
+        if DEBUG > 3:
+            print(f'DEBUG: shm attached key={self.key:#010x} id={self.memory.id} size={self.memory.size}')
+
+    def detach(self):
+        """ release view and detach from segment, waits for a running snapshot() """
+        with self.lock:
+            if self.view is not None:
+                self.view.release()
+                self.view = None
+            if self.memory is not None:
+                try:
+                    self.memory.detach()
+                except sysv_ipc.Error:
+                    pass
+                self.memory = None
+            self.prev = None
+            self.users = {}
+
+    def get_changed(self, buf) -> set:
+        """ compare slots with previous image, return changed slot numbers """
+        if _WITH_NUMPY:
+            image = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(-1, STRUCT_SIZE)
+            if self.prev is None or self.prev.shape != image.shape:
+                changed = set(range(image.shape[0]))
+            else:
+                changed = set(numpy.flatnonzero((image != self.prev).any(axis=1)).tolist())
+            self.prev = image.copy()
+            return changed
+        slots = len(buf) // STRUCT_SIZE
+        if self.prev is None or len(self.prev) != len(buf):
+            changed = set(range(slots))
+        else:
+            changed = {
+                slot for slot in range(slots)
+                if buf[slot*STRUCT_SIZE:(slot+1)*STRUCT_SIZE] != self.prev[slot*STRUCT_SIZE:(slot+1)*STRUCT_SIZE]
+            }
+        self.prev = bytes(buf)
+        return changed
+
+    def is_stale(self) -> bool:
+        """ check if glftpd removed segment, a recreated one (new shmid/size) always implies this """
+        if self.memory is None:
+            return True
+        try:
+            return bool(self.memory.mode & SHM_DEST)
+        except sysv_ipc.Error:
+            return True
+
+    def read(self):
+        """ return buffer with current segment contents, reattach if needed
+            caller holds self.lock while using the buffer """
+        if self.is_stale():
+            self.attach()
+        if self.view is not None:
+            return self.view
+        buf = self.memory.read()
+        return buf[:len(buf) - len(buf) % STRUCT_SIZE]
+
+    def snapshot(self) -> Snapshot:
+        """ decode changed slots only, reuse cached users for the rest """
+        start = time.perf_counter()
+        with self.lock:
+            buf = self.read()
+            changed = self.get_changed(buf)
+            rows = decode_online_numpy(buf, changed) if _WITH_NUMPY else decode_online(buf, changed)
+            for slot in changed:
+                self.users.pop(slot, None)
+            for (slot, user_tuple, bytes_xfer, bytes_txfer) in rows:
+                self.users[slot] = User(user_tuple, bytes_xfer=bytes_xfer, bytes_txfer=bytes_txfer, slot=slot, site=self.site)
+            users = [self.users[slot] for slot in sorted(self.users)]
+            self.read_time = time.perf_counter() - start
+        if DEBUG > 3:
+            print(f'DEBUG: shm snapshot users={len(users)} changed={sorted(changed)}')
+        return Snapshot(users, frozenset(changed))
+
+
+class SnapshotCache:
+    """ process-wide latest snapshot, published by SamplerThread at a fixed rate or,
+        without sampler, shared by all requests until older than max_age """
+    timeout = 5                 # max secs to wait for sampler's first snapshot
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.snapshot = None
+        self.error = None
+        self.built = 0
+        self.build_time = 0     # secs the last refresh() took, incl shm read
+        self.version = 0
+        self.sampled = False
+        self.epoch = int(time.time())
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.published = threading.Condition(self.lock)
+
+    def is_fresh(self) -> bool:
+        """ check age of cached snapshot """
+        return self.ready.is_set() and time.monotonic() - self.built < self.max_age
+
+    def refresh(self):
+        """ build and publish new snapshot with next version, caller holds self.lock """
+        start = time.perf_counter()
+        try:
+            snapshot = build_snapshot()
+        # any error only fails this refresh, sampler keeps ticking and tries again
+        except Exception as err:    # pylint: disable=broad-except
+            if DEBUG > 0 and not isinstance(err, RuntimeError):
+                print(f'DEBUG: snapshot error {err!r}')
+            self.snapshot = None
+            self.error = err
+        else:
+            # every sample gets a new version, online/idle times and date move on
+            # even when no slot changed
+            self.version += 1
+            self.snapshot = snapshot._replace(version=self.version)
+            self.error = None
+        self.build_time = time.perf_counter() - start
+        self.built = time.monotonic()
+        self.ready.set()
+        self.published.notify_all()
+        if DEBUG > 2:
+            print(f'DEBUG: snapshot version={self.version} resolver {HOST_RESOLVER.get_stats()}')
+
+    def get(self) -> Snapshot:
+        """ return latest snapshot, without sampler rebuild it if needed and make
+            concurrent misses wait for a single rebuild """
+        if self.sampled:
+            if not self.ready.wait(self.timeout):
+                raise RuntimeError('No snapshot published yet')
+        elif not self.is_fresh():
+            with self.lock:
+                if not self.is_fresh():
+                    self.refresh()
+        (snapshot, error) = (self.snapshot, self.error)
+        if snapshot is None:
+            raise RuntimeError(str(error))
+        return snapshot
+
+    def peek_version(self) -> int:
+        """ version of published snapshot if it is still current, without building one.
+            None if there is none or it has to be rebuilt first """
+        if self.snapshot is None or not ((self.sampled and self.ready.is_set()) or self.is_fresh()):
+            return None
+        return self.version
+
+    def get_etag(self, version) -> str:
+        """ strong etag for version, epoch makes it unique across restarts """
+        return f'{self.epoch}.{version}'
+
+    def wait(self, version, timeout) -> bool:
+        """ block until a snapshot newer than version is published or timeout,
+            without sampler just sleep until the cached one can be rebuilt """
+        if not self.sampled:
+            time.sleep(min(max(self.max_age, 1), timeout))
+            return True
+        with self.published:
+            return self.published.wait_for(lambda: self.version != version, timeout)
+
+
+SNAPSHOT_CACHE = SnapshotCache(SNAPSHOT_MAX_AGE)
+
+
+class SamplerThread(threading.Thread):
+    """ Thread that reads shm and publishes a new snapshot 'rate' times per sec """
+    def __init__(self, cache, rate):
+        super().__init__(daemon=True)
+        self.cache = cache
+        self.cache.sampled = True
+        self.interval = 1 / rate
+
+    def run(self):
+        """ Start sampling, on evenly spaced ticks """
+        next_tick = time.monotonic()
+        while True:
+            with self.cache.lock:
+                self.cache.refresh()
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            # running behind, skip missed ticks
+            if delay < 0:
+                next_tick = time.monotonic()
+                delay = 0
+            time.sleep(delay)
+
+
+class EventBroker:
+    """ server-sent events for webspy: each snapshot version is rendered once per
+        view (key) and the same bytes are sent to every subscriber of that view """
+    heartbeat = 15              # secs between keep-alive comments when idle
+    size = 64                   # max cached views
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.rendered = LruDict(self.size)
+        self.lock = threading.Lock()
+        self.subscribers = 0
+
+    def render(self, key, render_func) -> tuple:
+        """ return (fragments, event) for latest snapshot, render_func(snapshot) only
+            runs for the first subscriber that sees a new version """
+        try:
+            snapshot = self.cache.get()
+        except RuntimeError:
+            snapshot = None
+        version = snapshot.version if snapshot else -1
+        with self.lock:
+            entry = self.rendered.get(key)
+            if entry and entry[0] == version:
+                self.rendered.move_to_end(key)
+                return entry[1:]
+            fragments = render_func(snapshot)
+            data = json.dumps(dict(version=version, **fragments))
+            event = f'id: {version}\nevent: update\ndata: {data}\n\n'.encode()
+            self.rendered[key] = (version, fragments, event)
+        return (fragments, event)
+
+    @classmethod
+    def sse(cls, cache, poll):
+        """ server-sent events generator shared by /events and /api/events: poll()
+            returns next event or None, it runs again for every new snapshot version
+            and heartbeats are sent while there is nothing new """
+        yield b'retry: 3000\n\n'
+        last_sent = time.monotonic()
+        while True:
+            version = cache.version
+            event = poll()
+            if event:
+                yield event
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= cls.heartbeat:
+                yield b': heartbeat\n\n'
+                last_sent = time.monotonic()
+            cache.wait(version, cls.heartbeat)
+
+    def stream(self, key, render_func):
+        """ generator for one subscriber, yields events on new versions with changed
+            content and heartbeats in between. every sample is a new version, those
+            that render the same fragments (e.g. nobody online) are not sent """
+        last_fragments = None
+        def poll():
+            nonlocal last_fragments
+            (fragments, event) = self.render(key, render_func)
+            if fragments == last_fragments:
+                return None
+            last_fragments = fragments
+            return event
+        with self.lock:
+            self.subscribers += 1
+        try:
+            yield from self.sse(self.cache, poll)
+        finally:
+            with self.lock:
+                self.subscribers -= 1
+
+
+EVENT_BROKER = EventBroker(SNAPSHOT_CACHE)
+
+
+class FragmentCache:
+    """ rendered webspy templates in LRU keyed by (version, route, view args),
+        concurrent misses for the same key wait for a single render """
+    size = 128                  # max cached fragments
+
+    def __init__(self):
+        self.cache = LruDict(self.size)
+        self.inflight = {}
+        self.stats = dict(hits=0, misses=0, waits=0)
+        self.lock = threading.Lock()
+
+    def get(self, key, render_func) -> str:
+        """ return cached fragment or render it once for all requests asking for key """
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.cache[key]
+            done = self.inflight.get(key)
+            owner = done is None
+            if owner:
+                self.stats['misses'] += 1
+                done = self.inflight[key] = threading.Event()
+            else:
+                self.stats['waits'] += 1
+        if not owner:
+            done.wait()
+            with self.lock:
+                if key in self.cache:
+                    return self.cache[key]
+            # render failed for other request, try again here
+        try:
+            fragment = render_func()
+            with self.lock:
+                self.cache[key] = fragment
+        finally:
+            with self.lock:
+                if self.inflight.get(key) is done:
+                    del self.inflight[key]
+            done.set()
+        return fragment
+
+    def get_stats(self) -> dict:
+        """ counters and hit rate """
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses'] + self.stats['waits']
+            return dict(
+                self.stats,
+                evictions=self.cache.evictions,
+                cached=len(self.cache),
+                hit_rate=round((self.stats['hits'] + self.stats['waits']) / lookups, 3) if lookups else 0
+            )
+
+
+FRAGMENT_CACHE = FragmentCache()
+
+
+class UserQuery:
+    """ sort, unique, search and paging over users of a snapshot. sort keys per attribute
+        and a lowercase search index are built once per snapshot version """
+    size = 4                    # max indexed versions
+    sort_keys = {
+        'name':     lambda user: user.name.lower(),
+        'group':    lambda user: user.group.lower(),
+        'status':   lambda user: user.get('status').lower(),
+        'online':   lambda user: -user.get('login_time'),
+        'path':     lambda user: user.get('currentdir'),
+        'speed':    lambda user: user.speed,
+        'site':     lambda user: user.site.name.lower() if user.site else "",
+    }
+
+    def __init__(self):
+        self.indexes = LruDict(self.size)
+        self.lock = threading.Lock()
+
+    def get_index(self, snapshot) -> dict:
+        """ keys, search text and cached sort orders for snapshot """
+        with self.lock:
+            index = self.indexes.get(snapshot.version)
+            if index is None:
+                index = dict(
+                    keys={},
+                    orders={},
+                    search=[
+                        "\n".join((
+                            user.name, user.group, user.get('host'), user.addr, user.ip,
+                            user.get('tagline'), user.get('currentdir'), user.site.name if user.site else ""
+                        )).lower()
+                        for user in snapshot.users
+                    ]
+                )
+                self.indexes[snapshot.version] = index
+            return index
+
+    def get_keys(self, index, users, attr) -> list:
+        """ sort key of every user for attr, None for unknown attributes """
+        if attr not in self.sort_keys:
+            return None
+        if attr not in index['keys']:
+            index['keys'][attr] = [self.sort_keys[attr](user) for user in users]
+        return index['keys'][attr]
+
+    def query(self, snapshot, sort_attr=None, sort_rev=False, uniq_attr=None, search=None, offset=0, limit=None) -> tuple:
+        """ return (users, matched), users is the requested page of sorted, unique and
+            matching users and matched the number of users on all pages """
+        users = snapshot.users
+        index = self.get_index(snapshot)
+        order = index['orders'].get((sort_attr, sort_rev))
+        if order is None:
+            keys = self.get_keys(index, users, sort_attr)
+            order = list(range(len(users)))
+            if keys is not None:
+                order.sort(key=keys.__getitem__, reverse=sort_rev)
+            elif sort_rev:
+                order.reverse()
+            index['orders'][(sort_attr, sort_rev)] = order
+        # keep first user of each value, like jinja's unique filter
+        uniq = self.get_keys(index, users, uniq_attr)
+        if uniq is not None:
+            seen = set()
+            order = [i for i in order if not (uniq[i] in seen or seen.add(uniq[i]))]
+        if search:
+            search = search.lower()
+            order = [i for i in order if search in index['search'][i]]
+        page = order[offset:offset + limit] if limit else order[offset:]
+        return ([users[i] for i in page], len(order))
+
+
+USER_QUERY = UserQuery()
+
+
+def get_view(args) -> dict:
+    """ users view from request args (dict like): sort_attr, sort_rev, uniq_attr, search,
+        offset and limit. unknown sort_attr keeps login order """
+    sort_attr = args.get('sort_attr', 'username')
+    if sort_attr == '' and args.get('sort_rev'):
+        sort_attr = 'name'
+    try:
+        offset = max(int(args.get('offset') or 0), 0)
+        limit = max(int(args.get('limit') or 0), 0) or None
+    except ValueError:
+        (offset, limit) = (0, None)
+    return dict(
+        sort_attr=sort_attr,
+        sort_rev=bool(args.get('sort_rev')),
+        uniq_attr=args.get('uniq_attr') or None,
+        search=args.get('search') or None,
+        offset=offset,
+        limit=limit,
+    )
+
+
+class SnapshotApi:
+    """ compact json documents of snapshots for /api/snapshot, serialized once per version.
+        keeps a short history of encoded versions to send deltas since an older one """
+    history = 32                # max versions to diff against
+    size = 64                   # max cached delta bodies
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.versions = LruDict(self.history)
+        self.bodies = LruDict(self.size)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def encode_user(user) -> dict:
+        """ user fields for api, speeds in KiB/s """
+        return dict(
+            name=user.name,
+            group=user.group,
+            tagline=user.get('tagline'),
+            status=user.get('status'),
+            currentdir=user.get('currentdir'),
+            host=user.addr,
+            ip=user.ip,
+            iso_code=user.iso_code,
+            ssl=User.tls_mode[user.get('ssl_flag')] if user.get('ssl_flag') in range(len(User.tls_mode)) else None,
+            procid=user.get('procid'),
+            login_time=user.get('login_time'),
+            traf_dir=user.get_traf_dir(),
+            filename=user.filename,
+            filesize=user.filesize,
+            bytes_xfer=user.bytes_xfer,
+            speed=round(user.speed, 1),
+            speed_avg=round(user.speed_avg, 1),
+            speed_ewma=round(user.speed_ewma, 1),
+            pct=round(user.pct, 1),
+            eta=user.eta,
+            site=user.site.name if user.site else None,
+        )
+
+    @staticmethod
+    def get_key(user) -> str:
+        """ session key of user in deltas """
+        return f"{user.get('procid')}:{user.get('login_time')}"
+
+    def parse_since(self, since) -> int:
+        """ version from 'since' param or last event id: '<version>' or '<epoch>.<version>'
+            as in etag, None if invalid or from another process """
+        try:
+            (epoch, _, version) = str(since).strip('"').rpartition('.')
+            if epoch and int(epoch) != self.cache.epoch:
+                return None
+            return int(version)
+        except ValueError:
+            return None
+
+    def store(self, snapshot) -> dict:
+        """ encode users of snapshot once and add them to history """
+        users = self.versions.get(snapshot.version)
+        if users is None:
+            users = {self.get_key(user): self.encode_user(user) for user in snapshot.users}
+            self.versions[snapshot.version] = users
+        return users
+
+    def encode_header(self, snapshot) -> dict:
+        """ version, time and totals of snapshot, without users """
+        return dict(
+            version=snapshot.version,
+            epoch=self.cache.epoch,
+            time=round(snapshot.time, 3),
+            totals=snapshot.totals._asdict(),
+            totalusers=get_totalusers(),
+            sites={
+                name: dict(totals._asdict(), totalusers=get_totalusers(SITES_BY_NAME.get(name)))
+                for name, totals in (snapshot.sites or {}).items()
+            },
+        )
+
+    def encode(self, snapshot, since=None) -> dict:
+        """ whole snapshot as dict, or only changes since older version in history,
+            caller holds self.lock """
+        users = self.store(snapshot)
+        doc = self.encode_header(snapshot)
+        old = self.versions.get(since) if since is not None and since <= snapshot.version else None
+        if old is None:
+            doc['users'] = list(users.values())
+            return doc
+        doc['since'] = since
+        doc['added'] = [user for key, user in users.items() if key not in old]
+        doc['removed'] = [key for key in old if key not in users]
+        doc['changed'] = {}
+        for key, user in users.items():
+            if key in old and user != old[key]:
+                doc['changed'][key] = {field: val for field, val in user.items() if old[key].get(field) != val}
+        return doc
+
+    def get(self, snapshot, since=None) -> bytes:
+        """ return serialized snapshot or delta, reuse body while version is unchanged.
+            falls back to full snapshot if since is too old """
+        with self.lock:
+            if since not in self.versions:
+                since = None
+            key = (snapshot.version, since)
+            body = self.bodies.get(key)
+            if body is None:
+                body = json.dumps(self.encode(snapshot, since), separators=(',', ':')).encode()
+                self.bodies[key] = body
+            return body
+
+    def get_view(self, snapshot, view) -> bytes:
+        """ serialized snapshot with only the users in view, see UserQuery """
+        with self.lock:
+            users = self.store(snapshot)
+        (page, matched) = USER_QUERY.query(snapshot, **view)
+        doc = self.encode_header(snapshot)
+        doc.update(
+            users=[users[self.get_key(user)] for user in page],
+            matched=matched,
+            offset=view['offset'],
+            limit=view['limit'],
+        )
+        return json.dumps(doc, separators=(',', ':')).encode()
+
+    def stream(self, since=None):
+        """ generator for server-sent events, first a full snapshot (or delta since
+            last event id) then deltas for every new version, heartbeats in between """
+        def poll():
+            nonlocal since
+            try:
+                snapshot = self.cache.get()
+            except RuntimeError:
+                return None
+            if snapshot.version == since:
+                return None
+            body = self.get(snapshot, since)
+            since = snapshot.version
+            return f'id: {self.cache.get_etag(snapshot.version)}\nevent: snapshot\ndata: '.encode() + body + b'\n\n'
+        return EventBroker.sse(self.cache, poll)
+
+
+SNAPSHOT_API = SnapshotApi(SNAPSHOT_CACHE)
+
+
+# one row per recorded snapshot, sessions is list of RecordSession (empty unless record_sessions is set)
+Record = collections.namedtuple(
+    'Record',
+    'time version onlineusers uploads downloads browsers idlers total_up_speed total_dn_speed sessions'
+)
+RecordSession = collections.namedtuple('RecordSession', 'procid login_time username traf_dir speed bytes_xfer')
+
+
+class RecordFile:
+    """ time-series of snapshots in a preallocated ring file, read through mmap so a
+        range query only touches the records it returns. records are written in time
+        order, so start of a range is found by binary search on the oldest..newest seq """
+    magic = b'SPYREC01'
+    header = struct.Struct('<8sQIII')           # magic, count (records ever written), slot size, capacity, sessions
+    header_size = 64                            # records start aligned after header
+    record = struct.Struct('<dIHHHHHddH')       # time, version, online, up, dn, browsers, idlers, up/dn speed, sessions
+    session = struct.Struct('<iI24sc3xfQ')      # procid, login_time, username, traf_dir, speed (KiB/s), bytes_xfer
+    count = struct.Struct('<Q')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file_obj:
+            self.mm = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        self.read_header()
+
+    def read_header(self):
+        """ get ring geometry from header and check file size matches """
+        (magic, _, self.slot_size, self.capacity, self.sessions) = self.header.unpack_from(self.mm, 0)
+        if magic != self.magic or self.slot_size != self.record.size + self.sessions * self.session.size \
+                or len(self.mm) < self.header_size + self.capacity * self.slot_size:
+            raise ValueError(f'{self.path} is not a spy record file')
+
+    def get_count(self) -> int:
+        """ number of records ever written, next one goes to seq 'count' """
+        return self.count.unpack_from(self.mm, 8)[0]
+
+    def get_seqs(self) -> range:
+        """ seq of oldest to newest record still in the ring """
+        count = self.get_count()
+        return range(max(0, count - self.capacity), count)
+
+    def get_offset(self, seq) -> int:
+        """ file offset of slot for seq """
+        return self.header_size + (seq % self.capacity) * self.slot_size
+
+    def get_time(self, seq) -> float:
+        """ time of record, without unpacking the rest """
+        return struct.unpack_from('<d', self.mm, self.get_offset(seq))[0]
+
+    def read(self, seq) -> Record:
+        """ unpack record and its session rows """
+        offset = self.get_offset(seq)
+        fields = self.record.unpack_from(self.mm, offset)
+        sessions = []
+        for idx in range(min(fields[-1], self.sessions)):
+            (procid, login_time, username, traf_dir, speed, bytes_xfer) = \
+                self.session.unpack_from(self.mm, offset + self.record.size + idx * self.session.size)
+            sessions.append(RecordSession(
+                procid, login_time, username.split(NULL_CHAR, 1)[0].decode(errors='replace'),
+                {b'U': "Up", b'D': "Dn"}.get(traf_dir), speed, bytes_xfer
+            ))
+        return Record(*fields[:-1], sessions)
+
+    def bisect(self, seqs, when) -> int:
+        """ first seq in seqs with time >= when """
+        (lo, hi) = (seqs.start, seqs.stop)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_time(mid) < when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get_range(self, start=None, end=None, limit=0) -> list:
+        """ records with start <= time < end (unix time, None for oldest/newest), with
+            limit only the newest 'limit' of them. records overwritten by a writer
+            in another process while reading are skipped """
+        seqs = self.get_seqs()
+        first = self.bisect(seqs, start) if start is not None else seqs.start
+        stop = self.bisect(range(first, seqs.stop), end) if end is not None else seqs.stop
+        if limit:
+            first = max(first, stop - limit)
+        records = [self.read(seq) for seq in range(first, stop)]
+        oldest = self.get_count() - self.capacity
+        return [record for seq, record in zip(range(first, stop), records) if seq >= oldest]
+
+    def close(self):
+        """ unmap file """
+        self.mm.close()
+
+
+class Recorder(RecordFile):
+    """ appends snapshots to ring file, creates and preallocates it on first use.
+        every append is one fixed size write into the mapping, then the count in header
+        is bumped so readers never see a half written record as newest """
+    def __init__(self, path, capacity, sessions=0):    # pylint: disable=super-init-not-called
+        self.path = path
+        slot_size = self.record.size + sessions * self.session.size
+        size = self.header_size + capacity * slot_size
+        with open(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as file_obj:
+            if os.fstat(file_obj.fileno()).st_size == 0:
+                file_obj.truncate(size)
+                file_obj.seek(0)
+                file_obj.write(self.header.pack(self.magic, 0, slot_size, capacity, sessions).ljust(self.header_size, NULL_CHAR))
+                file_obj.flush()
+            self.mm = mmap.mmap(file_obj.fileno(), 0)
+        self.read_header()
+        if (self.capacity, self.sessions) != (capacity, sessions):
+            self.mm.close()
+            raise ValueError(
+                f'{path} has record_max={self.capacity} record_sessions={self.sessions}, remove it to change them'
+            )
+        self.lock = threading.Lock()
+
+    def append(self, snapshot):
+        """ write totals and (first 'sessions') users of snapshot to slot of next seq """
+        totals = snapshot.totals
+        users = snapshot.users[:self.sessions]
+        with self.lock:
+            seq = self.get_count()
+            offset = self.get_offset(seq)
+            self.record.pack_into(
+                self.mm, offset, snapshot.time or time.time(), snapshot.version % pow(2, 32),
+                *(min(n, 65535) for n in (totals.onlineusers, totals.uploads, totals.downloads, totals.browsers, totals.idlers)),
+                totals.total_up_speed, totals.total_dn_speed, len(users)
+            )
+            offset += self.record.size
+            for user in users:
+                self.session.pack_into(
+                    self.mm, offset, user.get('procid'), user.get('login_time'), user.name.encode()[:24],
+                    {"Up": b'U', "Dn": b'D'}.get(user.get_traf_dir(), b' '), user.speed, user.bytes_xfer
+                )
+                offset += self.session.size
+            self.count.pack_into(self.mm, 8, seq + 1)
+
+    def close(self):
+        """ write dirty pages to disk and unmap file """
+        self.mm.flush()
+        super().close()
+
+
+class RecorderThread(threading.Thread):
+    """ Thread that appends every new snapshot version to recorder, at most once per 'interval' secs """
+    def __init__(self, cache, recorder, interval):
+        super().__init__(daemon=True)
+        self.cache = cache
+        self.recorder = recorder
+        self.interval = interval
+
+    def run(self):
+        """ Start recording """
+        version = None
+        while True:
+            next_tick = time.monotonic() + self.interval
+            try:
+                snapshot = self.cache.get()
+            except RuntimeError:
+                # no shm segment means nobody is logged in, record that too
+                snapshot = Snapshot(users=(), changed=set(), version=self.cache.version, time=time.time())
+                version = None
+            if snapshot.version != version:
+                self.recorder.append(snapshot)
+                version = snapshot.version
+            time.sleep(max(0, next_tick - time.monotonic()))
+
+
+RECORDER = None
+RECORD_READER = None
+if RECORD_FILE and (RECORD_ENABLE or RECORD_MODE):
+    try:
+        RECORDER = RECORD_READER = Recorder(RECORD_FILE, RECORD_MAX, RECORD_SESSIONS)
+    except (IOError, ValueError) as record_err:
+        print(f'Error: record_file {record_err}')
+        sys.exit(1)
+elif RECORD_FILE and (HTTPD_MODE or FLASK_MODE) and os.path.isfile(RECORD_FILE):
+    # written by another 'spy --record' process
+    try:
+        RECORD_READER = RecordFile(RECORD_FILE)
+    except (IOError, ValueError) as record_err:
+        print(f'Warning: record_file {record_err}')
+
+
+class MetricsExporter:
+    """ prometheus text format of latest published snapshot for /metrics. never reads
+        shm itself, the body is rendered once per snapshot refresh and shared by all
+        scrapes until the next one. per user series only with 'users' set """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, cache, users=False):
+        self.cache = cache
+        self.users = users
+        self.key = None
+        self.body = b''
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def escape(value) -> str:
+        """ escape label value """
+        return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+    def add(self, lines, name, text, samples, kind='gauge'):
+        """ append help, type and samples, a sample is a value or (labels, value) """
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for sample in samples:
+            (labels, value) = sample if isinstance(sample, tuple) else ({}, sample)
+            if labels:
+                labels = ','.join(f'{k}="{self.escape(v)}"' for k, v in labels.items())
+                lines.append(f'{name}{{{labels}}} {value}')
+            else:
+                lines.append(f'{name} {value}')
+
+    def encode(self, snapshot) -> bytes:
+        """ gauges for snapshot (None if there is none), speeds in bytes/s """
+        lines = []
+        self.add(lines, 'spy_up', 'Last shm read succeeded', [int(snapshot is not None)])
+        self.add(lines, 'spy_snapshot_build_seconds', 'Time to build last snapshot, incl shm read', [self.cache.build_time])
+        self.add(lines, 'spy_shm_read_seconds', 'Time to read and decode shm for last snapshot', [({'site': site.name}, site.shm_reader.read_time) for site in SITES])
+        self.add(lines, 'spy_snapshots_total', 'Snapshots built since start', [self.cache.version], 'counter')
+        if snapshot is None:
+            return ('\n'.join(lines) + '\n').encode()
+        totals = snapshot.totals
+        self.add(lines, 'spy_snapshot_timestamp_seconds', 'Unix time of snapshot', [snapshot.time])
+        self.add(lines, 'spy_users_online', 'Logged in sessions', [totals.onlineusers])
+        self.add(lines, 'spy_uploads', 'Sessions uploading', [totals.uploads])
+        self.add(lines, 'spy_downloads', 'Sessions downloading', [totals.downloads])
+        self.add(lines, 'spy_browsers', 'Sessions browsing', [totals.browsers])
+        self.add(lines, 'spy_idlers', 'Sessions idle', [totals.idlers])
+        self.add(lines, 'spy_upload_speed_bytes', 'Total upload speed in bytes/s', [totals.total_up_speed * 1024])
+        self.add(lines, 'spy_download_speed_bytes', 'Total download speed in bytes/s', [totals.total_dn_speed * 1024])
+        sites = sorted((snapshot.sites or {}).items())
+        self.add(lines, 'spy_site_users_online', 'Logged in sessions per site', [({'site': name}, t.onlineusers) for name, t in sites])
+        self.add(lines, 'spy_site_uploads', 'Sessions uploading per site', [({'site': name}, t.uploads) for name, t in sites])
+        self.add(lines, 'spy_site_downloads', 'Sessions downloading per site', [({'site': name}, t.downloads) for name, t in sites])
+        self.add(lines, 'spy_site_browsers', 'Sessions browsing per site', [({'site': name}, t.browsers) for name, t in sites])
+        self.add(lines, 'spy_site_idlers', 'Sessions idle per site', [({'site': name}, t.idlers) for name, t in sites])
+        self.add(lines, 'spy_site_upload_speed_bytes', 'Upload speed per site in bytes/s', [({'site': name}, t.total_up_speed * 1024) for name, t in sites])
+        self.add(lines, 'spy_site_download_speed_bytes', 'Download speed per site in bytes/s', [({'site': name}, t.total_dn_speed * 1024) for name, t in sites])
+        groups = collections.defaultdict(lambda: [0, 0, 0])
+        users = collections.defaultdict(lambda: [0, 0, 0])
+        # [sessions, up speed, dn speed] per (group, site) and, with self.users, per (user, group, site)
+        for user in snapshot.users:
+            traf_dir = user.get_traf_dir()
+            site = user.site.name if user.site else ""
+            rows = [groups[(user.group, site)]] + ([users[(user.name, user.group, site)]] if self.users else [])
+            for row in rows:
+                row[0] += 1
+                if traf_dir == "Up":
+                    row[1] += user.speed * 1024
+                elif traf_dir == "Dn":
+                    row[2] += user.speed * 1024
+        for (name, label_keys, rows) in (('group', ('group', 'site'), groups), ('user', ('user', 'group', 'site'), users)):
+            if not rows:
+                continue
+            series = [(dict(zip(label_keys, key)), row) for key, row in sorted(rows.items())]
+            self.add(lines, f'spy_{name}_sessions', f'Logged in sessions per {name}', [(labels, row[0]) for labels, row in series])
+            self.add(lines, f'spy_{name}_upload_speed_bytes', f'Upload speed per {name} in bytes/s', [(labels, row[1]) for labels, row in series])
+            self.add(lines, f'spy_{name}_download_speed_bytes', f'Download speed per {name} in bytes/s', [(labels, row[2]) for labels, row in series])
+        return ('\n'.join(lines) + '\n').encode()
+
+    def get(self) -> bytes:
+        """ body for latest refresh of cache, rendered on first scrape after it """
+        key = (self.cache.built, self.cache.version)
+        with self.lock:
+            if key != self.key:
+                self.body = self.encode(self.cache.snapshot)
+                self.key = key
+            return self.body
+
+
+METRICS_EXPORTER = MetricsExporter(SNAPSHOT_CACHE, METRICS_USERS)
+
+
+class FileIndex:
+    """ contents of first existing file in paths converted by parse(lines), reparsed
+        only when its inode, mtime or size changed. stat() at most every 'interval' secs.
+        default is the value while there is no file """
+    interval = 1
+
+    def __init__(self, paths, parse, default=None):
+        self.paths = paths
+        self.parse = parse
+        self.default = default
+        self.key = None
+        self.value = default
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """ return parsed value, reload if file changed """
+        if time.monotonic() - self.checked < self.interval:
+            return self.value
+        with self.lock:
+            self.checked = time.monotonic()
+            key = None
+            for path in self.paths:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                key = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                break
+            if key != self.key:
+                value = self.default
+                if key:
+                    try:
+                        with open(key[0], 'r', encoding='utf-8', errors='ignore') as fp:
+                            value = self.parse(fp.readlines())
+                    except IOError:
+                        pass
+                if DEBUG > 3:
+                    print(f'DEBUG: FileIndex {self.parse.__name__} loaded {key}')
+                self.key = key
+                self.value = value
+        return self.value
+
+
+def parse_groupfile(lines) -> tuple:
+    """ groupfile as ({gid: name}, {name: gid}), see FileIndex """
+    by_gid = {}
+    by_name = {}
+    for line in lines:
+        fields = line.split(':')
+        if len(fields) > 2 and fields[2].strip().lstrip('-').isdigit():
+            by_gid[int(fields[2])] = fields[0]
+            by_name[fields[0]] = int(fields[2])
+    return (by_gid, by_name)
+
+
+def parse_glconf(lines) -> int:
+    """ sum of 'max_users' from glftpd.conf, see FileIndex """
+    for line in lines:
+        if re.search(r'^max_users \d', line):
+            return sum(int(mu_cnt) for mu_cnt in line.split()[1:] if mu_cnt.isdigit())
+    return 0
+
+
+class UserfileCache:
+    """ parsed userfiles keyed by (path, mtime, size), optionally with a background
+        index of the whole users dir so lookups need no file reads """
+    size = 4096         # max cached userfiles
+
+    def __init__(self, users_dir):
+        self.users_dir = users_dir
+        self.cache = LruDict(self.size)
+        self.stats = dict(hits=0, misses=0, scans=0)
+        self.lock = threading.Lock()
+
+    def get_path(self, u_name) -> str:
+        """ path to userfile, None for invalid names """
+        if not self.users_dir or not u_name or u_name in ['.', '..'] or '/' in u_name:
+            return None
+        return os.path.join(self.users_dir, u_name)
+
+    def load(self, path, key) -> dict:
+        """ read and parse userfile, store result with key """
+        try:
+            with open(path, 'r', encoding='utf-8', errors='ignore') as userfile:
+                lines = userfile.readlines()
+        except (FileNotFoundError, IsADirectoryError):
+            return dict(status="FileNotFound")
+        result = dict(status="Success", result=parse_userfile(lines)) if lines else dict(status="UserNotFound")
+        with self.lock:
+            self.stats['misses'] += 1
+            self.cache[path] = (key, result)
+        return result
+
+    def get(self, u_name) -> dict:
+        """ return parsed userfile, only reread if mtime or size changed """
+        path = self.get_path(u_name)
+        try:
+            stat = os.stat(path) if path else None
+        except OSError:
+            stat = None
+        if stat is None:
+            return dict(status="FileNotFound")
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.cache.get(path)
+            if entry and entry[0] == key:
+                self.cache.move_to_end(path)
+                self.stats['hits'] += 1
+                return entry[1]
+        return self.load(path, key)
+
+    def peek(self, u_name) -> dict:
+        """ return cached userfile fields without touching disk, None if not cached """
+        entry = self.cache.get(self.get_path(u_name))
+        if entry and entry[1].get('status') == "Success":
+            return entry[1].get('result')
+        return None
+
+    def scan(self):
+        """ index users dir, reload changed userfiles and drop deleted ones """
+        found = set()
+        try:
+            with os.scandir(self.users_dir) as entries:
+                for entry in entries:
+                    if not entry.is_file() or entry.name.startswith('.'):
+                        continue
+                    stat = entry.stat()
+                    key = (entry.path, stat.st_mtime_ns, stat.st_size)
+                    found.add(entry.path)
+                    cached = self.cache.get(entry.path)
+                    if not cached or cached[0] != key:
+                        self.load(entry.path, key)
+        except (OSError, TypeError):
+            return
+        with self.lock:
+            for path in [path for path in self.cache if path not in found]:
+                del self.cache[path]
+            self.stats['scans'] += 1
+
+
+class UserfileIndexThread(threading.Thread):
+    """ Thread that rescans users dir every 'interval' secs """
+    def __init__(self, cache, interval):
+        super().__init__(daemon=True)
+        self.cache = cache
+        self.interval = interval
+
+    def run(self):
+        """ Start indexing """
+        while True:
+            self.cache.scan()
+            time.sleep(self.interval)
+
+
+class Site:
+    """ one glftpd instance with its own shm segment, groupfile, glftpd.conf and users dir.
+        users of all sites are read concurrently into one snapshot, see get_snapshot() """
+    def __init__(self, name, rootpath, site_key, site_maxusers):
+        self.name = name
+        self.rootpath = rootpath
+        self.key = int(site_key if site_key else "0x0000DEAD", 16)
+        self.maxusers = site_maxusers if site_maxusers else 0
+        self.shm_reader = ShmReader(self.key, self)
+        self.group_index = FileIndex([f'{rootpath}/etc/group'], parse_groupfile, ({}, {}))
+        # glftpd.conf for max_users if maxusers is -1
+        self.glconf_index = FileIndex([f'{rootpath}/../glftpd.conf', f'{rootpath}/glftpd.conf', '/etc/glftpd.conf'], parse_glconf, 0)
+        self.userfile_cache = UserfileCache(self.get_users_dir())
+        self.gl_ver = self.get_gl_ver()
+        if DEBUG > 3:
+            print(f'DEBUG:\tsite={name} rootpath={rootpath} ipc_key={self.key:#010x} sysv_ipc.SHM_RDONLY={sysv_ipc.SHM_RDONLY}')
+
+    def get_gl_ver(self) -> str:
+        """ version string from glftpd binary """
+        try:
+            glbin_popt = dict(stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            with subprocess.Popen(f'{self.rootpath}/bin/glftpd', **glbin_popt) as glbin_proc:
+                glbin_out, glbin_err = glbin_proc.communicate()
+                if not glbin_err:
+                    return glbin_out.decode().split('\n', maxsplit=1)[0]
+        except (FileNotFoundError, PermissionError):
+            pass
+        return ""
+
+    def get_users_dir(self) -> str:
+        """ users dir (/ftp-data/users), chroot'ed path as fallback """
+        for gl_udir_name in [f"{self.rootpath}/ftp-data/users", "/ftp-data/users"]:
+            if os.path.isdir(gl_udir_name):
+                return gl_udir_name
+        return None
+
+    def get_group(self, gid) -> str:
+        """ get group name using gid """
+        return self.group_index.get()[0].get(gid, "")
+
+    def get_gid(self, g_name) -> int:
+        """ get group id using name """
+        return self.group_index.get()[1].get(g_name, 0)
+
+    def get_totalusers(self) -> int:
+        """ max users from spy.conf, or from glftpd.conf if set to -1 """
+        glconf_maxusers = self.glconf_index.get()
+        if self.maxusers == -1 and glconf_maxusers > 0:
+            return glconf_maxusers
+        return self.maxusers
+
+
+SITES = []
+for site_config in site_configs:
+    try:
+        SITES.append(Site(*site_config))
+    except ValueError as site_err:
+        print(f'Error: site {site_config[0]} ipc_key {site_err}')
+        sys.exit(1)
+SITES_BY_NAME = {site.name: site for site in SITES}
+
+# first site, used where only one site makes sense
+SITE = SITES[0]
+SHM_READER = SITE.shm_reader
+USERFILE_CACHE = SITE.userfile_cache
+GL_VER = SITE.gl_ver
+
+# reads shm of all sites at the same time
+SITE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=len(SITES), thread_name_prefix='site') if len(SITES) > 1 else None
+
+
+class FilesizeCache:
+    """ size of files being downloaded, an entry is valid for the whole transfer session
+        (procid, tstart) as the file doesnt change. misses are looked up in background """
+    size = 512          # max cached paths
+    workers = 2
+
+    def __init__(self):
+        self.cache = LruDict(self.size)
+        self.pending = set()
+        self.stats = dict(hits=0, misses=0)
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='filesize')
+
+    def get(self, path, session, rootpath=None) -> int:
+        """ return cached filesize for path in session, None while lookup runs.
+            path is (chroot'ed) path from shm, rootpath that of user's site """
+        path = (rootpath, path)
+        with self.lock:
+            entry = self.cache.get(path)
+            if entry and entry[0] == session:
+                self.cache.move_to_end(path)
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+            if (path, session) not in self.pending:
+                self.pending.add((path, session))
+                self.executor.submit(self.lookup, path, session)
+        return None
+
+    def lookup(self, path, session):
+        """ stat file and store size, runs in thread pool """
+        filesize = get_filesize(path[1], path[0])
+        with self.lock:
+            self.cache[path] = (session, filesize)
+            self.pending.discard((path, session))
+
+
+FILESIZE_CACHE = FilesizeCache()
+
+
+class GeoipWeb:
+    """ geoip2 web service backend, counts against daily query limit """
+    def __init__(self):
+        self.client = geoip2.webservice.Client(
+            geoip2_accountid,
+            geoip2_licensekey,
+            host='geolite.info',
+            proxy=None if geoip2_proxy in [None, 'None'] else geoip2_proxy
+        )
+
+    def country(self, ip) -> str:
+        """ get country code for ip """
+        return self.client.country(ip).country.iso_code
+
+    def close(self):
+        """ close client """
+        self.client.close()
+
+
+class GeoipMmdb:
+    """ local GeoLite2/GeoIP2 country .mmdb backend, fully offline """
+    def __init__(self, path):
+        self.reader = geoip2.database.Reader(path)
+
+    def country(self, ip) -> str:
+        """ get country code for ip """
+        return self.reader.country(ip).country.iso_code
+
+    def close(self):
+        """ close db """
+        self.reader.close()
+
+
+class GeoipCache:
+    """ country codes from geoip backend in LRU with TTL, persisted to cachefile,
+        unknown ips are looked up in background """
+    size = 4096                 # max cached ips
+    ttl = 7 * 86400             # secs to keep country code
+    neg_ttl = 86400             # secs to keep not found
+    backoff = 3600              # secs to pause lookups after running out of queries
+
+    def __init__(self, backend, cachefile=None):
+        self.backend = backend
+        self.cachefile = cachefile
+        self.cache = LruDict(self.size)
+        self.pending = set()
+        self.paused = 0
+        self.shown_err = False
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='geoip')
+        self.load()
+
+    def load(self):
+        """ read persistent cache from disk, skip expired entries """
+        if not self.cachefile:
+            return
+        try:
+            with open(self.cachefile, 'r', encoding='utf-8') as fp:
+                entries = json.load(fp)
+        except (IOError, ValueError):
+            return
+        for ip, (iso_code, expires) in sorted(entries.items(), key=lambda i: i[1][1]):
+            if expires > time.time():
+                self.cache[ip] = (iso_code, expires)
+
+    def save(self):
+        """ write cache to disk, replace file atomically """
+        if not self.cachefile:
+            return
+        with self.lock:
+            entries = dict(self.cache)
+        try:
+            with open(f'{self.cachefile}.tmp', 'w', encoding='utf-8') as fp:
+                json.dump(entries, fp)
+            os.replace(f'{self.cachefile}.tmp', self.cachefile)
+        except IOError as err:
+            if DEBUG > 0:
+                print(f'DEBUG: geoip2 cachefile {err}')
+
+    def get(self, ip) -> str:
+        """ return cached country code, "" for private and unknown ips, None if not cached """
+        try:
+            if not ipaddress.ip_address(ip).is_global:
+                return ""
+        except ValueError:
+            return ""
+        with self.lock:
+            entry = self.cache.get(ip)
+            if entry and entry[1] > time.time():
+                self.cache.move_to_end(ip)
+                return entry[0]
+        return None
+
+    def lookup(self, ips):
+        """ queue one background job for all ips not already pending """
+        ips = {ip for ip in ips if self.get(ip) is None}
+        with self.lock:
+            ips -= self.pending
+            if not ips or time.monotonic() < self.paused:
+                return
+            self.pending |= ips
+        self.executor.submit(self.resolve, ips)
+
+    def resolve(self, ips):
+        """ get country codes from backend and store them, runs in background.
+            ips that failed are no longer pending, so the next snapshot retries them """
+        try:
+            for ip in ips:
+                try:
+                    (iso_code, ttl) = (self.backend.country(ip) or "", self.ttl)
+                except ValueError:
+                    (iso_code, ttl) = ("", self.neg_ttl)
+                except geoip2.errors.AddressNotFoundError:
+                    (iso_code, ttl) = ("", self.neg_ttl)
+                # web service doesnt wrap connection errors and timeouts from requests
+                except (geoip2.errors.GeoIP2Error, OSError) as err:
+                    # show error only once
+                    if not self.shown_err and (DEBUG > 0 or not CLI_MODE):
+                        print(f"Error: geoip2 {err.__class__.__name__} {err}")
+                    self.shown_err = True
+                    if isinstance(err, geoip2.errors.OutOfQueriesError):
+                        self.paused = time.monotonic() + self.backoff
+                        break
+                    continue
+                with self.lock:
+                    self.cache[ip] = (iso_code, time.time() + ttl)
+        finally:
+            with self.lock:
+                self.pending -= ips
+            self.save()
+
+    def close(self):
+        """ save cache and close backend """
+        self.executor.shutdown(wait=False)
+        self.save()
+        self.backend.close()
+
+
+GEOIP_CACHE = None
+if _WITH_GEOIP and GEOIP2_ENABLE:
+    try:
+        GEOIP_CACHE = GeoipCache(GeoipMmdb(GEOIP2_MMDB) if GEOIP2_MMDB else GeoipWeb(), GEOIP2_CACHEFILE)
+    except (IOError, ValueError) as geoip_err:
+        print(f'Error: geoip2 {geoip_err}')
+        sys.exit(1)
+
+
+class SpeedSampler:
+    """ per transfer session ring buffer of (timestamp, bytes) samples,
+        gives current speed from latest deltas and ewma smoothed speed in KiB/s """
+    size = 16           # max samples per session
+    window = 2          # secs of samples used for current speed
+    alpha = 0.3         # ewma weight of newest speed
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def update(self, keys, bytes_xfer, now) -> list:
+        """ add sample for every session key (procid, tstart), None means no transfer,
+            sessions that are gone get dropped. returns [(cur_speed, ewma_speed), ...] """
+        result = []
+        sessions = {}
+        with self.lock:
+            for key, b_xfer in zip(keys, bytes_xfer):
+                if key is None:
+                    result.append((None, None))
+                    continue
+                (samples, ewma) = self.sessions.get(key, (collections.deque(maxlen=self.size), None))
+                added = not samples or now > samples[-1][0]
+                if added:
+                    samples.append((now, b_xfer))
+                cur = None
+                if len(samples) > 1:
+                    # oldest sample inside window, but at least the one before newest
+                    ref = samples[-2]
+                    for sample in samples:
+                        if now - sample[0] <= self.window:
+                            ref = sample if sample is not samples[-1] else ref
+                            break
+                    cur = max(samples[-1][1] - ref[1], 0) / 1024 / (samples[-1][0] - ref[0])
+                    if added:
+                        ewma = cur if ewma is None else self.alpha * cur + (1 - self.alpha) * ewma
+                sessions[key] = (samples, ewma)
+                result.append((cur, ewma))
+            self.sessions = sessions
+        return result
+
+
+SPEED_SAMPLER = SpeedSampler()
+
+
+class HostResolver:
+    """ cached hostname to ip lookups, resolved in background by a small thread pool
+        so a refresh never blocks on dns """
+    size = 1024         # max cached hosts
+    ttl = 3600          # secs to keep resolved ip
+    neg_ttl = 300       # secs to keep failed lookup
+    workers = 4
+
+    def __init__(self):
+        self.cache = LruDict(self.size)
+        self.pending = set()
+        self.stats = dict(hits=0, misses=0, lookups=0, failed=0, latency=0.0)
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='resolver')
+
+    def get(self, addr) -> str:
+        """ return cached ip, stale entries are returned while being refreshed,
+            None if first lookup is still running """
+        with self.lock:
+            entry = self.cache.get(addr)
+            if entry and entry[1] > time.monotonic():
+                self.cache.move_to_end(addr)
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+            if addr not in self.pending:
+                self.pending.add(addr)
+                self.executor.submit(self.resolve, addr)
+        return entry[0] if entry else None
+
+    def resolve(self, addr):
+        """ lookup host and store result, runs in thread pool """
+        start = time.monotonic()
+        try:
+            (ip, ttl) = (socket.gethostbyname(addr), self.ttl)
+        except OSError:
+            (ip, ttl) = ('0.0.0.0', self.neg_ttl)
+        with self.lock:
+            self.stats['lookups'] += 1
+            self.stats['failed'] += 1 if ttl == self.neg_ttl else 0
+            self.stats['latency'] += time.monotonic() - start
+            self.cache[addr] = (ip, time.monotonic() + ttl)
+            self.pending.discard(addr)
+
+    def get_stats(self) -> str:
+        """ format hit/miss/latency counters for debug output """
+        with self.lock:
+            avg = self.stats['latency'] / self.stats['lookups'] * 1000 if self.stats['lookups'] else 0
+            return "hits={hits} misses={misses} lookups={lookups} failed={failed}".format(**self.stats) + \
+                   f" avg_latency={avg:.1f}ms cached={len(self.cache)} pending={len(self.pending)}"
+
+
+HOST_RESOLVER = HostResolver()
+
+
+class PageCache:
+    """ httpd response bodies rendered once per snapshot version and kept as bytes,
+        plus gzipped copies of bodies """
+    size = 32                   # max cached bodies per kind
+    min_gzip = 512              # dont compress small bodies
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.pages = LruDict(self.size)
+        self.compressed = LruDict(self.size)
+        self.lock = threading.Lock()
+
+    def get(self, key, render_func) -> tuple:
+        """ return (version, body) for latest snapshot, render_func(snapshot) only runs once
+            per version. version is -1 if there is no snapshot """
+        try:
+            snapshot = self.cache.get()
+        except RuntimeError:
+            snapshot = None
+        version = snapshot.version if snapshot else -1
+        with self.lock:
+            entry = self.pages.get(key)
+            if not entry or entry[0] != version:
+                entry = (version, render_func(snapshot))
+                self.pages[key] = entry
+            self.pages.move_to_end(key)
+        return entry
+
+    def compress(self, body) -> bytes:
+        """ gzip body, reuse result while the same (cached) body object is sent again """
+        if len(body) < self.min_gzip:
+            return None
+        with self.lock:
+            entry = self.compressed.get(id(body))
+            if entry and entry[0] is body:
+                return entry[1]
+        data = gzip.compress(body, compresslevel=6)
+        with self.lock:
+            # keep a reference to body so its id cant be reused while cached
+            self.compressed[id(body)] = (body, data)
+        return data
+
+
+PAGE_CACHE = PageCache(SNAPSHOT_CACHE)
+
+
 class Handler(http.server.BaseHTTPRequestHandler):
-    """ HTTP Requests """
+    """ HTTP Requests, keep-alive """
+    protocol_version = "HTTP/1.1"
+    timeout = 60                # close idle keep-alive connections
+    head = "\n".join([
+        "<!DOCTYPE html><html lang='en'>",
+        "<head>",
+        "  <title>webspy | http.server</title>",
+        "  <style>",
+        "    html { font-family: 'Courier New', monospace; }",
+        "  </style>",
+        " <meta http-equiv='Refresh' content='1'>",
+        "</head>",
+        "<body>",
+    ])
+
     def do_GET(self):
         """ GET Method """
-        head = [
-            "<!DOCTYPE html><html lang='en'>",
-            "<head>",
-            "  <title>webspy | http.server</title>",
-            "  <style>",
-            "    html { font-family: 'Courier New', monospace; }",
-            "  </style>",
-            " <meta http-equiv='Refresh' content='1'>",
-            "</head>",
-            "<body>",
-        ]
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/api/snapshot':
+            query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+            self.send_body(*get_api_snapshot(self.headers.get('If-None-Match'), query.get('since'), query))
+        elif url.path == '/metrics':
+            self.send_body(200, {'Content-Type': MetricsExporter.content_type}, METRICS_EXPORTER.get())
+        elif url.path == '/api/history':
+            self.send_body(*get_api_history(dict(urllib.parse.parse_qsl(url.query))))
+        elif url.path in ['/', '/index.html', '/html']:
+            self.send_page()
+        else:
+            self.send_body(404, {'Content-Type': 'text/plain'}, b'Not Found\n')
+
+    def send_page(self):
+        """ html page with users and totals, 304 if client has current version """
+        headers = {'Content-Type': 'text/html; charset=utf-8', 'Cache-Control': 'no-cache'}
+        etag = get_not_modified(self.headers.get('If-None-Match'))
+        if etag:
+            headers['ETag'] = etag
+            self.send_body(304, headers, b'')
+            return
+        (version, body) = PAGE_CACHE.get('html', lambda snapshot: f"{self.head}\n{format_html(snapshot)}\n</body>\n</html>\n".encode())
+        # without sampler a stale snapshot is only rebuilt by get(), check again
+        etag = get_not_modified(self.headers.get('If-None-Match'), version) if version >= 0 else None
+        if etag:
+            headers['ETag'] = etag
+            self.send_body(304, headers, b'')
+            return
+        if version >= 0:
+            headers['ETag'] = f'"{SNAPSHOT_CACHE.get_etag(version)}"'
+        self.send_body(200, headers, body)
+
+    def send_body(self, status, headers, body):
+        """ send response with Content-Length, gzipped if client accepts it """
+        # same url can be sent with or without gzip, also tell caches about identity responses
+        if status in [200, 304]:
+            headers = dict(headers, Vary='Accept-Encoding')
+        if status == 200 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = PAGE_CACHE.compress(body)
+            if data:
+                (body, headers) = (data, dict(headers, **{'Content-Encoding': 'gzip'}))
+                # strong etag has to differ per content-coding
+                if 'ETag' in headers:
+                    headers['ETag'] = f'{headers["ETag"][:-1]}-gz"'
+        self.send_response(status)
+        for header in headers.items():
+            self.send_header(*header)
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        for line in head:
-            self.wfile.write(bytes(f"{line}\n", "utf-8"))
-        self.wfile.write(bytes(format_html(), "utf-8"))
-        self.wfile.write(bytes("\n</body>\n", "utf-8"))
-        self.wfile.write(bytes("</html>\n", "utf-8"))
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):   # pylint: disable=redefined-builtin
+        """ only log requests when debugging """
+        if DEBUG > 0:
+            super().log_message(format, *args)
 
 
 class TCPServerThread(threading.Thread):
-    """ Thread for http server """
+    """ Thread for http server, one thread per connection """
     def run(self):
         """ Start server """
-        with socketserver.TCPServer((HTTPD_OPTIONS), Handler, False) as httpd:
+        with http.server.ThreadingHTTPServer((HTTPD_OPTIONS), Handler, False) as httpd:
             httpd.allow_reuse_address = True
+            httpd.daemon_threads = True
             httpd.server_bind()
             httpd.server_activate()
             httpd.serve_forever()
@@ -504,21 +2047,36 @@ class Theme:
     delimiter = f"{maincolor}|{Style('r')}"   # pipe '|'
     vchar = f"{maincolor}{draw['v']}{Style('r')}"
 
+    size = None                 # term (columns, lines), set on start and SIGWINCH
+    cached = (None, {})         # width dependent attrs for size
+
     def __init__(self):
-        self.columns = self.get_columns()
-        self.lines = self.get_lines()
+        if Theme.size is None:
+            Theme.resize()
+        if Theme.cached[0] == Theme.size:
+            self.__dict__.update(Theme.cached[1])
+            return
+        (self.columns, self.lines) = Theme.size
         self.max_col = self.columns - 11
         self.fill = " " * self.columns if self.columns > 80 else ""
         self.separator = self.fmt_separator()
         self.header = self.fmt_header()
         self.footer = self.fmt_footer()
         self.spacer = self.fmt_spacer()
+        Theme.cached = (Theme.size, dict(self.__dict__))
+
+    @classmethod
+    def resize(cls, *_):
+        """ get term size, also used as SIGWINCH handler """
+        cls.size = (cls.get_columns(), cls.get_lines())
 
-    def get_columns(self) -> int:
+    @staticmethod
+    def get_columns() -> int:
         """ get term width """
         return os.get_terminal_size().columns if os.get_terminal_size().columns > 1 else 80
 
-    def get_lines(self) -> int:
+    @staticmethod
+    def get_lines() -> int:
         """ get term height """
         return os.get_terminal_size().lines if os.get_terminal_size().lines > 1 else 25
 
@@ -560,25 +2118,172 @@ class Theme:
         return "{v} {sp:>4.4}{text:<{col}.{col}} {v}".format(v=self.vchar, sp=' ', text=text, col=col)
 
 
+class FrameBuffer:
+    """ cli screen as rows of (style, char) cells from last frame, render() only writes
+        cells that changed using cursor addressing, in a single write """
+    sgr = re.compile(r'\x1b\[[0-9;]*m')
+
+    def __init__(self):
+        self.rows = []
+        self.size = None
+
+    def invalidate(self):
+        """ clear and redraw whole screen on next render, after other output """
+        self.size = None
+
+    @classmethod
+    def parse(cls, text) -> list:
+        """ split line into cells, style is all sgr codes since last reset """
+        cells = []
+        style = ''
+        pos = 0
+        for match in cls.sgr.finditer(text):
+            cells.extend((style, char) for char in text[pos:match.start()])
+            style = '' if match.group() == '\x1b[0m' else style + match.group()
+            pos = match.end()
+        cells.extend((style, char) for char in text[pos:])
+        return cells
+
+    def render(self, lines, size, cursor=(0, 0), overlays=()):
+        """ draw lines, overlays are (row, col, text) put on top. leaves cursor at (row, col) """
+        rows = [self.parse(line) for line in lines[:size[1]]]
+        for (y, x, text) in overlays:
+            if y < len(rows):
+                cells = self.parse(text)
+                rows[y] = rows[y][:x] + [('', ' ')] * (x - len(rows[y])) + cells + rows[y][x + len(cells):]
+        out = []
+        if size != self.size:
+            out.append(f"{Style('r')}{Esc('2J')}")
+            (self.rows, self.size) = ([], size)
+        for y, cells in enumerate(rows):
+            old = self.rows[y] if y < len(self.rows) else []
+            if cells == old:
+                continue
+            # only write from first to last changed cell
+            start = 0
+            while start < min(len(cells), len(old)) and cells[start] == old[start]:
+                start += 1
+            end = len(cells)
+            if len(cells) == len(old):
+                while end > start and cells[end - 1] == old[end - 1]:
+                    end -= 1
+            out.append(Esc(f'{y + 1};{start + 1}H'))
+            style = None
+            for (cell_style, char) in cells[start:end]:
+                if cell_style != style:
+                    out.append(f"{Style('r')}{cell_style}")
+                    style = cell_style
+                out.append(char)
+            out.append(Style('r'))
+            if len(cells) < len(old):
+                out.append(Esc('K'))
+        for y in range(len(rows), len(self.rows)):
+            out.append(f"{Esc(f'{y + 1};1H')}{Esc('2K')}")
+        self.rows = rows
+        out.append(Esc(f'{cursor[0] + 1};{cursor[1] + 1}H'))
+        sys.stdout.write(''.join(out))
+        sys.stdout.flush()
+
+
+class KeyReader:
+    """ keys from stdin, which stays in cbreak mode for the whole session. escape sequences
+        are decoded by a small state machine into the codes cli_input() knows """
+    esc_timeout = 0.05          # secs to wait for rest of escape sequence
+    seq_keys = {
+        'A': '\N{ESC}[A',       # UP
+        'B': '\N{ESC}[B',       # DOWN
+        'C': '\N{ESC}[C',       # RIGHT
+        'D': '\N{ESC}[D',       # LEFT
+        'H': '\N{ESC}[1',       # HOME
+        '1~': '\N{ESC}[1',
+        '7~': '\N{ESC}[1',
+        'F': '\N{ESC}[4',       # END
+        '4~': '\N{ESC}[4',
+        '8~': '\N{ESC}[4',
+        '5~': '\N{ESC}[5',      # PGUP
+        '6~': '\N{ESC}[6',      # PGDN
+    }
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(fd, selectors.EVENT_READ)
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self.keys = collections.deque()
+        self.state = 'key'      # key, esc or seq (after 'ESC [' or 'ESC O')
+        self.seq = ''
+
+    def feed(self, data):
+        """ run state machine over input bytes, queue complete keys """
+        for char in self.decoder.decode(data):
+            if self.state == 'esc':
+                if char in ['[', 'O']:
+                    (self.state, self.seq) = ('seq', '')
+                    continue
+                # ESC followed by normal key
+                self.keys.append('\N{ESC}')
+                self.state = 'key'
+            if self.state == 'seq':
+                self.seq += char
+                # sequence ends with a byte in range '@' to '~', unknown ones are dropped
+                if '@' <= char <= '~':
+                    if self.seq in self.seq_keys:
+                        self.keys.append(self.seq_keys[self.seq])
+                    self.state = 'key'
+            elif char == '\N{ESC}':
+                self.state = 'esc'
+            else:
+                self.keys.append(char)
+
+    def flush(self):
+        """ no more input after ESC: it was the ESC key, drop incomplete sequences """
+        if self.state == 'esc':
+            self.keys.append('\N{ESC}')
+        self.state = 'key'
+
+    def read_key(self, timeout=None) -> str:
+        """ return next key, '' if there was none within timeout secs (None waits forever) """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.keys:
+            if self.state != 'key':
+                wait = self.esc_timeout
+            elif deadline is None:
+                wait = None
+            else:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return ''
+            if self.selector.select(wait):
+                data = os.read(self.fd, 1024)
+                if not data:
+                    return ''
+                self.feed(data)
+            elif self.state != 'key':
+                self.flush()
+        return self.keys.popleft()
+
+
+KEY_READER = KeyReader(sys.stdin.fileno()) if CLI_MODE else None
+
+
 # functions
 ############
 
 def get_group(gid) -> str:
-    """ get group name using gid """
-    if GROUPFILE:
-        for line in GROUPFILE:
-            if line.split(':')[2] == str(gid):
-                return line.split(':')[0]
-    return ""
+    """ get group name using gid, of first site """
+    return SITE.get_group(gid)
 
 
 def get_gid(g_name) -> int:
-    """ get group id using name """
-    if GROUPFILE:
-        for line in GROUPFILE:
-            if line.split(':')[0] == g_name:
-                return line.split(':')[2]
-    return 0
+    """ get group id using name, of first site """
+    return SITE.get_gid(g_name)
+
+
+def get_totalusers(site=None) -> int:
+    """ max users of site, or of all sites combined """
+    if site:
+        return site.get_totalusers()
+    return sum(site.get_totalusers() for site in SITES)
 
 
 def get_idle(seconds) -> str:
@@ -586,9 +2291,9 @@ def get_idle(seconds) -> str:
     return time.strftime("%H:%M:%S", time.gmtime(seconds))
 
 
-def get_filesize(filename) -> int:
-    """ get filesize in bytes """
-    for file in filename, f'{glrootpath}{filename}':
+def get_filesize(filename, rootpath=None) -> int:
+    """ get filesize in bytes, path is tried as is and inside glftpd rootpath """
+    for file in filename, f'{rootpath or glrootpath}{filename}':
         try:
             return os.path.getsize(file)
         except OSError:
@@ -596,39 +2301,6 @@ def get_filesize(filename) -> int:
     return 0
 
 
-def get_geocode(client, userip, shown_err) -> list:
-    """ get geoip2 country code for ip """
-    iso_code = "xX"
-    theme = Theme()
-    if DEBUG > 0:
-        for prefix in ['127.', '10.', '172.16.1', '172.16.2', '172.16.3', '192.168.']:
-            if userip.startswith(prefix):
-                if DEBUG > 3:
-                    print(f'DEBUG: geoip2 MATCH "{prefix}" in "{userip}"')
-                return [client, 'DEBUG', shown_err]
-    if GEOIP2_BUF.get(userip):
-        iso_code = GEOIP2_BUF[userip]
-    else:
-        try:
-            if DEBUG == 1:
-                print(f'DEBUG: geoip2 "{userip}" not cached, GEOIP2_BUF="{GEOIP2_BUF}"')
-            iso_code = client.country(userip).country.iso_code
-            GEOIP2_BUF[userip] = iso_code
-        except geoip2.errors.GeoIP2Error as err:
-            # var shown_err makes sure we only show the error once
-            if (err.__class__.__name__ in ['AddressNotFoundError', 'OutOfQueriesError']) and shown_err == 0:
-                shown_err = 1
-                text = f"{Color('r,k')}Error: geoip2 {err.__class__.__name__} {err}"
-                mcol = theme.max_col+8 if color else theme.max_col-8
-                if len(text) + 8 > mcol:
-                    text = text[:73] + ' ...'
-                print("{0} {1:<{2}.{2}} {0}".format(Theme.vchar, text, mcol))
-                print(theme.footer)
-                print(f"{Esc('2F')}", end="")
-                time.sleep(2.5)
-    return [client, iso_code, shown_err]
-
-
 def conv_speed(speed) -> list:
     """ convert and format speed """
     if speed > (THRESHOLD * THRESHOLD):
@@ -645,19 +2317,15 @@ def cli_stty_sane():
 
 
 def cli_input(user_action, cli_refresh=0.5):
-    """ read user input from stdin """
-    # put terminal in mode 'cbreak' or 'raw' (no CR, disables ISIG)
-    #   tty.setraw(), tty.setcbreak()
-    #   https://github.com/python/cpython/blob/3.7/Lib/tty.py
+    """ read user input from stdin, wait at most cli_refresh secs for a key """
+    # terminal is in mode 'cbreak' for the whole session, see cli_mainloop()
     screen_redraw = 0
-    key = ""
-    tty.setraw(sys.stdin.fileno())
-    if select.select([sys.stdin], [], [], cli_refresh) == ([sys.stdin], [], []):
-        key = sys.stdin.buffer.raw.read(3).decode(sys.stdin.encoding)
+    key = KEY_READER.read_key(cli_refresh)
+    if key:
         if key[:2].strip().isdigit():
             user_action = 1
         # [vV], ENTER, SPACE, RIGHT
-        elif ((key in ['v', 'V', '\r', '\x13', '\N{SPACE}']) or
+        elif ((key in ['v', 'V', '\r', '\n', '\x13', '\N{SPACE}']) or
               (user_action == 0 and key == '\N{ESC}[C')):
             key = 1
             user_action = 1
@@ -704,7 +2372,6 @@ def cli_input(user_action, cli_refresh=0.5):
         # CTRL-C
         elif key == '\x03':
             cli_sigint_handler(any, any)
-    tty.tcsetattr(sys.stdin, tty.TCSANOW, TTY_SETTINGS)
     return dict(key=key, user_action=user_action, screen_redraw=screen_redraw)
 
 
@@ -743,15 +2410,10 @@ def cli_user_info(users, u_idx, user_cache=[]) -> list:
         ssl_flag = users[u_idx].get('ssl_flag')
         ssl_msg = User.tls_mode[ssl_flag] if ssl_flag in range(0, len(User.tls_mode)) else 'UNKNOWN'
         ip = users[u_idx].ip
-        iso_code  = None
-        try:
-            iso_code = users[u_idx].iso_code
-        except AttributeError:
+        iso_code = users[u_idx].iso_code
+        if not iso_code:
             if u_idx in range(0, len(user_cache)) and users[u_idx].get('procid') == user_cache[u_idx].get('procid'):
-                try:
-                    iso_code = user_cache[u_idx].iso_code
-                except AttributeError:
-                    pass
+                iso_code = user_cache[u_idx].iso_code
         last_dl = '{:.1f}GB'.format(round(int(users[u_idx].get_bytes_txfer()) / 1024**3, 1))
         login_info = [
             f"Username: '{Style('b')}{users[u_idx].name}{Style('r')}' [{u_idx}/{len(users)-1}]",
@@ -772,7 +2434,7 @@ def cli_user_info(users, u_idx, user_cache=[]) -> list:
         if theme.lines > 25:
             print(theme.spacer)
             i += 1
-        r = get_userfile(users[u_idx].name)
+        r = get_userfile(users[u_idx].name, users[u_idx].site)
         if r.get('status') == "Success":
             print(theme.fmt_uinfo_title('Userfile', mcol_title))
             print(theme.spacer)
@@ -809,9 +2471,7 @@ def cli_action(user_action, key, screen_redraw, user_scroll, search_user):
     theme = Theme()
     # action: userinfo
     if user_action == 1:
-        users = []
-        for user in get_users():
-            users.append(set_stats(user))
+        users = SNAPSHOT_CACHE.get().users
         u_idx = p_cnt = 0
         # set u_idx from shortcut keys 0-9, search_user or user_scroll
         if isinstance(key, str) and key.isdigit() and int(key) in range(0, len(users)):
@@ -849,26 +2509,25 @@ def cli_action(user_action, key, screen_redraw, user_scroll, search_user):
             if input_result.get('user_action') == 4:
                 u_idx = u_idx + 1 if (u_idx + 1 < len(users)) else 0
                 print(f"{Esc('2J')}{Esc('H')}", end="")
-                cli_user_info(get_users(), u_idx, users)
+                cli_user_info(SNAPSHOT_CACHE.get().users, u_idx, users)
             # uinfo: prev
             elif input_result.get('user_action') == 5:
                 u_idx = u_idx-1 if (u_idx-1 < len(users) and u_idx > 0) else 0
                 print(f"{Esc('2J')}{Esc('H')}", end="")
-                cli_user_info(get_users(), u_idx, users)
+                cli_user_info(SNAPSHOT_CACHE.get().users, u_idx, users)
             # uinfo: help
             if input_result.get('user_action') == 3:
                 cli_dialog("Help", HELP_TEXT)
                 while not cli_input(user_action).get('key'):
                     time.sleep(0.1)
                 print(f"{Esc('2J')}{Esc('H')}", end="")
-                cli_user_info(get_users(), u_idx, users)
+                cli_user_info(SNAPSHOT_CACHE.get().users, u_idx, users)
             # uinfo: back (ESC), quit
             if input_result.get('user_action') in [6, 9]:
                 break
             p_cnt = 0 if p_cnt > 3 else p_cnt
             cli_uinfo_prompt(p_cnt)
             p_cnt += 1
-        tty.tcsetattr(sys.stdin, tty.TCSANOW, TTY_SETTINGS)
         user_action = input_result.get('user_action')
         screen_redraw = 1
     # action: show help popup
@@ -885,14 +2544,14 @@ def cli_action(user_action, key, screen_redraw, user_scroll, search_user):
         stdin_string = ""
         c = 0
         while True:
-            user_input = sys.stdin.read(1)
+            user_input = KEY_READER.read_key()
             # backspace
             if user_input in [ '\b', '\x08', '\x7f' ]:
                 c -= 1 if c > 0 else 0
                 stdin_string = stdin_string[:-1]
                 print(f"{Esc('1A')}{Esc(str(c+len(prompt)-9)+'C')} ")
             # ENTER
-            elif user_input == '\n':
+            elif user_input in ['\n', '\r']:
                 break
             else:
                 stdin_string += user_input
@@ -900,6 +2559,7 @@ def cli_action(user_action, key, screen_redraw, user_scroll, search_user):
                 c += 1
         search_user = stdin_string
         user_action = 0
+        screen_redraw = 1
     # action: quit (ESC)
     elif user_action == 9:
         cli_sigint_handler(any, any)
@@ -907,32 +2567,26 @@ def cli_action(user_action, key, screen_redraw, user_scroll, search_user):
     # action: scroll user list up (-1)
     elif user_action == 10:
         user_action = 0
-        screen_redraw = 1
         user_scroll -= 1
     # action: scroll user list down (+1)
     elif user_action == 11:
         user_action = 0
-        screen_redraw = 1
         user_scroll += 1
     # action: scroll to user list start (0)
     elif user_action == 12:
         user_action = 0
-        screen_redraw = 1
         user_scroll = 0
     # action: scroll to user list end
     elif user_action == 13:
         user_action = 0
-        screen_redraw = 1
-        user_scroll = len(get_users())-1
+        user_scroll = len(SNAPSHOT_CACHE.get().users)-1
     # action: scroll user list page up (-5)
     elif user_action == 14:
         user_action = 0
-        screen_redraw = 1
         user_scroll -= 5
     # action: scroll user list page down  (+5)
     elif user_action == 15:
         user_action = 0
-        screen_redraw = 1
         user_scroll += 5
     # handle any other key presses
     elif user_action == 0 and len(key) > 0:
@@ -945,47 +2599,34 @@ def cli_action(user_action, key, screen_redraw, user_scroll, search_user):
         time.sleep(1)
     else:
         user_action = 0
-        screen_redraw = 1
     return [user_action, screen_redraw, user_scroll, search_user]
 
 
-def get_userfile(u_name) -> dict:
-    """ get fields from userfile """
-    userfile_text = ""
-    try:
-        with open(f'{USERS_DIR}/{u_name}', 'r', encoding='utf-8', errors='ignore') as userfile:
-            userfile_text = userfile.readlines()
-    except FileNotFoundError:
-        return dict(status="FileNotFound")
-    if userfile_text == "":
-        return dict(status="UserNotFound")
+def parse_userfile(lines) -> dict:
+    """ get FLAGS, CREDITS, GROUP and IP fields from userfile lines """
     u_fields = {}
-    value = []
-    prev = ""
-    for line in userfile_text:
-        for key in ['FLAGS', 'CREDITS', 'GROUP', 'IP']:
-            if key in line:
-                if key != prev:
-                    value = []
-                if line.startswith('CREDITS'):
-                    value = 0
-                    try:
-                        c = int((re.sub(r'^CREDITS [^0](\d+).*', r'\1', line)).strip())
-                    except ValueError:
-                        pass
-                    if isinstance(c, int) and c > 0:
-                        value = f"{round(int(c) / 1024**2)}GB"
-                else:
-                    value.append(line.strip().split(' ')[1])
-                u_fields[key] = value
-                prev = key
-    return dict(status="Success", result=u_fields)
+    for line in lines:
+        fields = line.strip().split(' ')
+        if fields[0] not in ['FLAGS', 'CREDITS', 'GROUP', 'IP'] or len(fields) < 2:
+            continue
+        if fields[0] == 'CREDITS':
+            # first section, in KiB
+            c = int(fields[1]) if fields[1].isdigit() else 0
+            u_fields['CREDITS'] = f"{round(c / 1024**2)}GB" if c > 0 else 0
+        else:
+            u_fields.setdefault(fields[0], []).append(fields[1])
+    return u_fields
 
 
-def kill_procid(u_name, users):
-    """ kill user using procid """
+def get_userfile(u_name, site=None) -> dict:
+    """ get fields from userfile, of first site by default """
+    return (site or SITE).userfile_cache.get(u_name)
+
+
+def kill_procid(u_name, users, site=None):
+    """ kill user using procid, only logins on site if set """
     for user in users:
-        if user.name == u_name:
+        if user.name == u_name and (site is None or user.site is site):
             #if os.popen(f"ps --no-headers -o comm -p {user.get('procid')}").read().strip() == 'glftpd':
             with open(os.path.join('/proc', str(user.get('procid')), 'comm'), 'rb') as fp:
                 if fp.read().split(b'\x00')[0].decode().strip() == 'glftpd':
@@ -998,174 +2639,281 @@ def kill_procid(u_name, users):
     return dict(status="NotFound")
 
 
-def set_stats(user):
-    """ adds user statistics to object and summed totals as class var """
-    tstop_tv_sec = calendar.timegm(time.gmtime())
-    tstop_tv_usec = datetime.datetime.now().microsecond
-    user.speed = 0
-    user.fmt_status = ""
-
-    # get filename
-    if len(user.get('status')) > 4 and not user.get('status')[4:].startswith('-'):
-        user.filename = user.get('status')[5:]
-    if _WITH_GEOIP and GEOIP2_ENABLE:
-        try:
-            (User.geoip2_client, user.iso_code, User.geoip2_shown_err) = get_geocode(User.geoip2_client, user.ip, User.geoip2_shown_err)
-        except geoip2.errors.GeoIP2Error:
-            user.iso_code = None
-    # ul speed
-    if user.get_traf_dir() == "Up":
-        user.speed = abs(
-            user.get_bytes_xfer() / 1024 / ((tstop_tv_sec - user.get('tstart_tv_sec')) +
-            (tstop_tv_usec - user.get('tstart_tv_usec')) / 1000000)
+def get_stat_columns(traf_dir, bytes_xfer, tstart, login_time, filesize, cur_speed, now) -> list:
+    """ calc speed/pct/bar/idle/online columns and Totals for all users at once,
+        speed is current speed from sampler (cur_speed) or else average since transfer start """
+    if _WITH_NUMPY:
+        up = numpy.array([d == "Up" for d in traf_dir], dtype=bool)
+        dn = numpy.array([d == "Dn" for d in traf_dir], dtype=bool)
+        b_xfer = numpy.array(bytes_xfer, dtype=numpy.float64)
+        known = dn & (numpy.array(filesize, dtype=numpy.float64) > 0)
+        f_size = numpy.where(known, numpy.array(filesize, dtype=numpy.float64), 1)
+        elapsed = numpy.maximum(now - numpy.array(tstart, dtype=numpy.float64), 0.000001)
+        speed_avg = numpy.where(up | dn, b_xfer / 1024 / elapsed, 0)
+        cur = numpy.array([numpy.nan if c is None else c for c in cur_speed], dtype=numpy.float64)
+        speed = numpy.where(numpy.isnan(cur), speed_avg, cur)
+        idle = int(now) - numpy.array(tstart, dtype=numpy.float64).astype(numpy.int64)
+        idlers = ~(up | dn) & (idle > IDLE_BARRIER)
+        columns = dict(
+            speed = speed.tolist(),
+            speed_avg = speed_avg.tolist(),
+            pct = numpy.where(known, b_xfer / f_size * 100, numpy.where(up, -1, 0)).tolist(),
+            bar = numpy.where(known, numpy.minimum(15, 15 * b_xfer / f_size), 0).tolist(),
+            idle = idle.tolist(),
+            online = (int(now) - numpy.array(login_time, dtype=numpy.int64)).tolist()
         )
-        if FLASK_MODE:
-            flask.session['total_up_speed'] += user.speed
-            flask.session['uploads'] += 1
-        else:
-            User.total_up_speed += user.speed
-            User.uploads += 1
-        user.pct = -1
-        user.p_bar = '?->'
-    # dn speed
-    elif user.get_traf_dir() == "Dn":
-        realfile = user.get('currentdir')
-        user.filesize = get_filesize(realfile)
-        if user.filesize < user.get_bytes_xfer():
-            user.filesize = user.get_bytes_xfer()
-        user.pct = abs(
-            user.get_bytes_xfer() / user.filesize * 100
+        totals = dict(
+            uploads = int(up.sum()),
+            downloads = int(dn.sum()),
+            total_up_speed = float(speed[up].sum()),
+            total_dn_speed = float(speed[dn].sum()),
+            idlers = int(idlers.sum()),
+            browsers = int((~(up | dn)).sum() - idlers.sum())
         )
-        i = 15 * user.get_bytes_xfer() / user.filesize
-        i = 15 if i > 15 else i
-        user.p_bar = f"{'':x<{int(abs(i))}}"
-        user.speed = abs(
-           user.get_bytes_xfer() / 1024 / ((tstop_tv_sec - user.get('tstart_tv_sec')) +
-                (tstop_tv_usec - user.get('tstart_tv_usec')) / 1000000)
-        )
-        if FLASK_MODE:
-            flask.session['total_dn_speed'] += user.speed
-            flask.session['downloads'] += 1
-        else:
-            User.total_dn_speed += user.speed
-            User.downloads += 1
-    # idle time
     else:
-        user.p_bar = user.filename = ""
-        user.pct = 0
-        seconds = tstop_tv_sec - user.get('tstart_tv_sec')
-        if seconds > IDLE_BARRIER:
-            if FLASK_MODE:
-                flask.session['idlers'] += 1
+        columns = dict(speed=[], speed_avg=[], pct=[], bar=[], idle=[], online=[])
+        totals = dict(uploads=0, downloads=0, total_up_speed=0, total_dn_speed=0, idlers=0, browsers=0)
+        for (d, b, t, l, f, c) in zip(traf_dir, bytes_xfer, tstart, login_time, filesize, cur_speed):
+            speed_avg = b / 1024 / max(now - t, 0.000001) if d in ["Up", "Dn"] else 0
+            speed = speed_avg if c is None else c
+            idle = int(now) - int(t)
+            columns['speed'].append(speed)
+            columns['speed_avg'].append(speed_avg)
+            columns['pct'].append(b / f * 100 if d == "Dn" and f else (-1 if d == "Up" else 0))
+            columns['bar'].append(min(15, 15 * b / f) if d == "Dn" and f else 0)
+            columns['idle'].append(idle)
+            columns['online'].append(int(now) - l)
+            if d == "Up":
+                totals['uploads'] += 1
+                totals['total_up_speed'] += speed
+            elif d == "Dn":
+                totals['downloads'] += 1
+                totals['total_dn_speed'] += speed
+            elif idle > IDLE_BARRIER:
+                totals['idlers'] += 1
             else:
-                User.idlers += 1
-        else:
-            if FLASK_MODE:
-                flask.session['browsers'] += 1
-            else:
-                User.browsers += 1
-        user.fmt_status = 'Idle: {:>8.8}'.format(get_idle(seconds))
+                totals['browsers'] += 1
+    totals = Totals(
+        total = totals['uploads'] + totals['downloads'],
+        total_speed = totals['total_up_speed'] + totals['total_dn_speed'],
+        onlineusers = len(traf_dir),
+        **totals
+    )
+    return [columns, totals]
+
+
+def set_stats(users, now=None) -> list:
+    """ adds statistics to copies of all user objects in one pass using the same timestamp,
+        returns [users, totals] """
+    now = time.time() if now is None else now
+    traf_dir = [user.get_traf_dir() for user in users]
+
+    # dont touch cached users, they can be part of an older snapshot still being rendered
+    users = [copy.copy(user) for user in users]
+    geoip_pending = set()
+    for user, d in zip(users, traf_dir):
+        # pick up hostname lookups that finished in background. group name by gid from
+        # FileIndex, which only rereads groupfile when it changed
+        if user.ip == RESOLVING:
+            (user.addr, user.ip) = user.get_ip()
+        user.group = user.get_group()
+        # filesize from cache, 0 while lookup runs. bytes_xfer if file was not found
+        if d == "Dn":
+            filesize = FILESIZE_CACHE.get(user.get('currentdir'), user.get_session(), user.site.rootpath if user.site else None)
+            user.filesize = max(filesize, user.bytes_xfer) if filesize is not None else 0
+        if GEOIP_CACHE and user.iso_code is None and user.ip != RESOLVING:
+            user.iso_code = GEOIP_CACHE.get(user.ip)
+            if user.iso_code is None:
+                geoip_pending.add(user.ip)
+    # lookup all unknown ips from this snapshot in background, in one batch
+    if geoip_pending:
+        GEOIP_CACHE.lookup(geoip_pending)
+
+    # current and smoothed speed of transfers from sampled byte deltas
+    samples = SPEED_SAMPLER.update(
+        [user.get_session() if d else None for user, d in zip(users, traf_dir)],
+        [user.bytes_xfer for user in users],
+        now
+    )
 
-    user.online = get_idle(tstop_tv_sec - user.get('login_time'))
+    columns, totals = get_stat_columns(
+        traf_dir,
+        [user.bytes_xfer for user in users],
+        [user.get('tstart_tv_sec') + user.get('tstart_tv_usec') / 1000000 for user in users],
+        [user.get('login_time') for user in users],
+        [user.filesize for user in users],
+        [cur for (cur, _) in samples],
+        now
+    )
 
-    if user.get_traf_dir() in ["Up", "Dn"]:
-        user.fmt_status = '{}:{:2.2s}{}{}'.format(user.get_traf_dir(), ' ', *conv_speed(user.speed))
+    for i, user in enumerate(users):
+        if USERFILE_INDEX:
+            user.userfile = (user.site.userfile_cache if user.site else USERFILE_CACHE).peek(user.name)
+        user.speed = abs(columns['speed'][i])
+        user.speed_avg = abs(columns['speed_avg'][i])
+        user.speed_ewma = samples[i][1] if samples[i][1] is not None else user.speed_avg
+        user.pct = abs(columns['pct'][i]) if traf_dir[i] == "Dn" else columns['pct'][i]
+        user.eta = None
+        # ul
+        if traf_dir[i] == "Up":
+            user.p_bar = '?->'
+        # dn, eta only if real filesize is known
+        elif traf_dir[i] == "Dn":
+            user.p_bar = f"{'':x<{int(abs(columns['bar'][i]))}}"
+            if user.filesize > user.bytes_xfer and user.speed_ewma > 0:
+                user.eta = int((user.filesize - user.bytes_xfer) / 1024 / user.speed_ewma)
+        # idle time
+        else:
+            user.p_bar = ""
+            user.fmt_status = 'Idle: {:>8.8}'.format(get_idle(columns['idle'][i]))
+        user.online = get_idle(columns['online'][i])
+        if traf_dir[i] in ["Up", "Dn"]:
+            user.fmt_status = '{}:{:2.2s}{}{}'.format(traf_dir[i], ' ', *conv_speed(user.speed))
+
+    return [users, totals]
+
+
+def decode_online(buf, slots=None) -> list:
+    """ unpack occupied slots from shm buffer: [(slot, struct_ONLINE, bytes_xfer, bytes_txfer), ...]
+        optionally only the slot numbers in 'slots' """
+    rows = []
+    if slots is None:
+        slots = range(len(buf) // STRUCT_SIZE)
+    for slot in sorted(slots):
+        user_tuple = struct.unpack_from(STRUCT_FORMAT, buf, slot * STRUCT_SIZE)
+        # last field is procid, 0 means slot is free
+        if user_tuple[-1]:
+            row = struct_ONLINE._make(user_tuple)
+            rows.append((
+                slot, row,
+                row.bytes_xfer2 * pow(2, 32) + row.bytes_xfer1,
+                row.bytes_txfer2 * pow(2, 32) + row.bytes_txfer1
+            ))
+    return rows
+
+
+def decode_online_numpy(buf, slots=None) -> list:
+    """ same as decode_online, but view whole segment as structured array and
+        only turn occupied slots into python objects """
+    table = numpy.frombuffer(buf, dtype=ONLINE_DTYPE)
+    index = numpy.arange(table.shape[0]) if slots is None else numpy.array(sorted(slots), dtype=numpy.int64)
+    mask = table['procid'][index] != 0
+    online = table[index[mask]]
+    del table
+    bytes_xfer = (online['bytes_xfer2'].astype(numpy.uint64) << 32) | online['bytes_xfer1']
+    bytes_txfer = (online['bytes_txfer2'].astype(numpy.uint64) << 32) | online['bytes_txfer1']
+    return [
+        (slot, struct_ONLINE._make(row), xfer, txfer)
+        for slot, row, xfer, txfer in zip(
+            index[mask].tolist(), online.tolist(), bytes_xfer.tolist(), bytes_txfer.tolist()
+        )
+    ]
 
-    return user
 
+def get_snapshot() -> Snapshot:
+    """ get users from shm, with set of slots that changed since last call. multiple
+        sites are read concurrently and combined, a site without shm segment (nobody
+        logged in) is skipped unless all of them are """
+    if SITE_EXECUTOR is None:
+        return SHM_READER.snapshot()
+    futures = [SITE_EXECUTOR.submit(site.shm_reader.snapshot) for site in SITES]
+    users = []
+    changed = set()
+    errors = []
+    for site, future in zip(SITES, futures):
+        try:
+            snapshot = future.result()
+        except RuntimeError as err:
+            errors.append(err)
+            continue
+        users += snapshot.users
+        changed.update((site.name, slot) for slot in snapshot.changed)
+    if len(errors) == len(SITES):
+        raise errors[0]
+    return Snapshot(users, frozenset(changed))
 
-def get_users() -> list:
-    """ create list of user objects, from shm """ 
-    try:
-        memory = sysv_ipc.SharedMemory(KEY, flags=sysv_ipc.SHM_RDONLY, mode=0)
-    except sysv_ipc.ExistentialError as exc:
-        raise RuntimeError('No logged in users found') from exc
-    buf = memory.read()
 
-    # clear objects and class vars
-    user = None
-    users = []
-    User.uploads = UPLOADS
-    User.downloads = DOWNLOADS
-    User.total = 0
-    User.total_up_speed = TOTAL_UP_SPEED
-    User.total_dn_speed = TOTAL_DN_SPEED
-    User.total_speed = 0
-    User.browsers = BROWSERS
-    User.idlers = IDLERS
-
-    for user_tuple in struct.iter_unpack(STRUCT_FORMAT, buf):
-        if struct_ONLINE._make(user_tuple).procid:
-            user = User(struct_ONLINE._make(user_tuple))
-            users.append(user)
-
-    # set totals
-    User.onlineusers = len(users) if users else 0
-    User.total = User.uploads + User.downloads
-    User.total_speed = User.total_up_speed + User.total_dn_speed
+def get_site_totals(users, now) -> dict:
+    """ Totals per site name for users with stats, counted like get_stat_columns() """
+    sites = {site.name: dict(uploads=0, downloads=0, total_up_speed=0, total_dn_speed=0, idlers=0, browsers=0, onlineusers=0) for site in SITES}
+    for user in users:
+        totals = sites[user.site.name]
+        totals['onlineusers'] += 1
+        if user.get_traf_dir() == "Up":
+            totals['uploads'] += 1
+            totals['total_up_speed'] += user.speed
+        elif user.get_traf_dir() == "Dn":
+            totals['downloads'] += 1
+            totals['total_dn_speed'] += user.speed
+        elif int(now) - user.get('tstart_tv_sec') > IDLE_BARRIER:
+            totals['idlers'] += 1
+        else:
+            totals['browsers'] += 1
+    return {
+        name: Totals(
+            total = totals['uploads'] + totals['downloads'],
+            total_speed = totals['total_up_speed'] + totals['total_dn_speed'],
+            **totals
+        )
+        for name, totals in sites.items()
+    }
 
-    try:
-        memory.detach()
-    except (UnboundLocalError, sysv_ipc.Error):
-        pass
-    if _WITH_GEOIP and GEOIP2_ENABLE:
-        GEOIP2_CLIENT.close()
 
-    return users
+def build_snapshot(now=None) -> Snapshot:
+    """ get snapshot with user statistics and totals """
+    now = time.time() if now is None else now
+    snapshot = get_snapshot()
+    users, totals = set_stats(snapshot.users, now)
+    sites = {SITE.name: totals} if SITE_EXECUTOR is None else get_site_totals(users, now)
+    return snapshot._replace(users=tuple(users), totals=totals, time=now, sites=sites)
 
 def cli_mainloop():
     """ output users/totals to terminal """
-    theme = Theme()
+    frame = FrameBuffer()
     u_idx = 0
     repeat = 0              # init screen drawing related vars
     user_action = 0         # 1=userinfo 2=killuser 3=help 4=next 5=prev 6=back 7=search 9=quit
-    screen_redraw = 0       # 1=redraw theme.header
+    screen_redraw = 0       # 1=redraw whole screen after other output
     user_scroll = 0         # up=+1 down-1
     user_max = 15           # show max users per screen (on 80x25)
     user_list_maxlines = user_list_next = user_list_page = 0
     search_user = ""
 
-    print(f"{Esc('2J')}{Esc('H')}", end="")
-    print(theme.header)
+    # stay in cbreak mode, no line buffering or echo but CTRL-C still sends SIGINT
+    tty.setcbreak(sys.stdin.fileno())
+    signal.signal(signal.SIGWINCH, Theme.resize)
+    next_refresh = time.monotonic()
     while True:
         theme = Theme()
         signal.signal(signal.SIGINT, cli_sigint_handler)
+        if screen_redraw:
+            frame.invalidate()
+            screen_redraw = 0
         try:
-            users = []
-            for user in get_users():
-                users.append(set_stats(user))
+            snapshot = SNAPSHOT_CACHE.get()
+            (users, totals) = (snapshot.users, snapshot.totals)
         except RuntimeError:
             text = f"No users logged in.. Press {Style('b')}CTRL-C{Style('rb')} to quit"
-            print(f"{Esc('2J')}{Esc('H')}", end="")
-            print(theme.header)
-            print(theme.spacer)
-            print("{0} {1:<{2}.{2}} {0}".format(Theme.vchar, text, theme.max_col+9))
-            print(theme.spacer)
-            print(theme.footer)
-            print()
-            print(f"{Esc('4F')}")
-            time.sleep(1)
+            frame.render([
+                theme.header,
+                theme.spacer,
+                "{0} {1:<{2}.{2}} {0}".format(Theme.vchar, text, theme.max_col+9),
+                theme.spacer,
+                theme.footer,
+            ], Theme.size, cursor=(5, 0))
+            if KEY_READER.read_key(1) in ['q', 'Q', '\N{ESC}']:
+                cli_sigint_handler(any, any)
             continue
         if repeat > 0 and user_action == 0:
             # print vars for debugging, sleep to be able to actualy view them
             if DEBUG > 4:
                 print(f'DEBUG: cli vars user_action={user_action} screen_redraw={screen_redraw}')
                 time.sleep(2)
-            if screen_redraw == 0:
-                # go back up and clear x lines per user + totals + usage prompt
-                u_cnt = (len(users) * 1) if users else 0
-                l_up = str(u_cnt + 5 + 1)
-                print(f"{Esc(l_up+'F')}")
-                print(f"{Esc('0J')}{Esc('2F')}", end="")
-            else:
-                # erase screen, move cursor home and show header
-                print(f"{Esc('2J')}{Esc('H')}", end="")
-                print(f"{Esc('H')}", end="")
-                print(theme.header)
-                screen_redraw = 0
 
         # reset user idx for every repeat
         u_idx = 0
+        lines = [theme.header]
+        overlays = []
 
         # on max users, goto next screen
         if user_list_maxlines and not user_list_page and user_scroll > user_max:
@@ -1208,7 +2956,7 @@ def cli_mainloop():
                     menu_selector = f"{Color('k,w')} " if color else ">"
 
                 col = len(theme.fill) - 62 if len(theme.fill) > 0 else 18
-                print("{vchar}{ms}[{index:>2}] {username:16.16s}/{g_name:>10.10} {delimiter} {status:14.14s} {delimiter} {cli_info:{col}.{col}}{vchar}{rst}".format(
+                lines.append("{vchar}{ms}[{index:>2}] {username:16.16s}/{g_name:>10.10} {delimiter} {status:14.14s} {delimiter} {cli_info:{col}.{col}}{vchar}{rst}".format(
                     ms=menu_selector, vchar=Theme.vchar, delimiter=Theme.delimiter, username=user.name, g_name=user.group, index=u_idx, status=user.fmt_status,
                     cli_info=cli_info, col=col, rst=Style('r')
                 ))
@@ -1220,50 +2968,52 @@ def cli_mainloop():
                 user_list_maxlines = 1
                 if user_list_next == 0:
                     # show right side scroll indicator 'v'
-                    print(f"{Esc('1A')}{Esc(str(theme.max_col+3)+'C')}{Color('m,k')}v")
+                    overlays.append((len(lines) - 1, theme.max_col + 3, f"{Color('m,k')}v"))
                     break
 
         # fill screen, after last user (next page)
         if user_list_maxlines and user_list_next:
             i = 0
             while i + (len(users) - user_max) < theme.lines - 7:
-                print(theme.spacer)
+                lines.append(theme.spacer)
                 i += 1
 
-        # show totals
+        # show totals, usage text and user input prompt
         if user_action == 0:
-            total_up_speed, total_up_unit = conv_speed(User.total_up_speed)
-            total_dn_speed, total_dn_unit = conv_speed(User.total_dn_speed)
-            total_speed, total_unit = conv_speed(User.total_speed)
+            total_up_speed, total_up_unit = conv_speed(totals.total_up_speed)
+            total_dn_speed, total_dn_unit = conv_speed(totals.total_dn_speed)
+            total_speed, total_unit = conv_speed(totals.total_speed)
             i = 0
             # fill screen; after last user, add 8 lines for totals + prompt
             while u_idx + 8 + i < theme.lines:
-                print(theme.spacer)
+                lines.append(theme.spacer)
                 i += 1
-            print(theme.separator)
-            print("{vchar} Up: {uploads:>2} / {total_up_speed:6}{up_unit:5} {delimiter} Dn: {downloads:>2} / {total_dn_speed:6}{dn_unit:5} {delimiter} Total: {total:>2} / {total_speed:6}{total_unit:5} {fill}{vchar}".format(
+            lines.append(theme.separator)
+            lines.append("{vchar} Up: {uploads:>2} / {total_up_speed:6}{up_unit:5} {delimiter} Dn: {downloads:>2} / {total_dn_speed:6}{dn_unit:5} {delimiter} Total: {total:>2} / {total_speed:6}{total_unit:5} {fill}{vchar}".format(
                 vchar=Theme.vchar, delimiter=Theme.delimiter,
-                uploads=users[0].uploads, total_up_speed=total_up_speed, up_unit=total_up_unit,
-                downloads=users[0].downloads, total_dn_speed=total_dn_speed, dn_unit=total_dn_unit,
-                total=users[0].total, total_speed=total_speed, total_unit=total_unit, fill=f'{" "*(theme.columns-80)}'
+                uploads=totals.uploads, total_up_speed=total_up_speed, up_unit=total_up_unit,
+                downloads=totals.downloads, total_dn_speed=total_dn_speed, dn_unit=total_dn_unit,
+                total=totals.total, total_speed=total_speed, total_unit=total_unit, fill=f'{" "*(theme.columns-80)}'
             ))
-            print("{vchar} Currently {onlineusers:>3}{rb} of {maxusers:>3} users are online... {space:19} {curtime} {fill}{vchar}".format(
-                vchar=Theme.vchar, space=' ', onlineusers=users[0].onlineusers, rb=Style('rb'), maxusers=TOTALUSERS, fill=f'{" "*(theme.columns-80)}',
+            lines.append("{vchar} Currently {onlineusers:>3}{rb} of {maxusers:>3} users are online... {space:19} {curtime} {fill}{vchar}".format(
+                vchar=Theme.vchar, space=' ', onlineusers=totals.onlineusers, rb=Style('rb'), maxusers=get_totalusers(), fill=f'{" "*(theme.columns-80)}',
                 curtime = datetime.datetime.now().strftime("%T")
             ))
-            print(theme.footer)
-            print()
-
-        # show usage text and user input prompt
-        if user_action == 0:
-            prompt = f"> View user details with {Color('k,w')}v{Style('r')} " \
-                     f"or press {Color('k,w')}h{Style('r')} key for help. " \
-                     f"Press {Style('b')}CTRL-C{Style('rb')} to quit"
-            print(prompt, end="")
-            print(f"{Esc('1A')}")
-
-        # handle keyboard input
-        input_result = cli_input(user_action, REFRESH)
+            lines.append(theme.footer)
+            lines.append("")
+            lines.append(
+                f"> View user details with {Color('k,w')}v{Style('r')} "
+                f"or press {Color('k,w')}h{Style('r')} key for help. "
+                f"Press {Style('b')}CTRL-C{Style('rb')} to quit"
+            )
+            # whole frame at once, cursor at start of prompt line
+            frame.render(lines, Theme.size, cursor=(len(lines) - 1, 0), overlays=overlays)
+
+        # handle keyboard input right away, redraw on keys and every refresh secs
+        now = time.monotonic()
+        if now >= next_refresh:
+            next_refresh = now + REFRESH
+        input_result = cli_input(user_action, 0 if user_action else next_refresh - now)
         [user_action, screen_redraw, user_scroll, search_user] = cli_action(
             **input_result,
             user_scroll=user_scroll,
@@ -1297,32 +3047,110 @@ def cli_sigint_handler(signal_received, frame):
     print(f"{Esc('1E')}")
     print(f'\n{"Exiting spy.py...":<{theme.columns}}\n')
     print(Style('r'), end="")
-    if _WITH_GEOIP and GEOIP2_ENABLE:
-        GEOIP2_CLIENT.close()
+    for site in SITES:
+        site.shm_reader.detach()
+    if GEOIP_CACHE:
+        GEOIP_CACHE.close()
     sys.exit(0)
 
 
-def format_html() -> str:
+def format_html(snapshot=None) -> str:
     """ return string with users/totals as html """
-    html = "<h3>SPY.PY</h3><br>\n"
-    users = []
-    try:
-        for user in get_users():
-            users.append(set_stats(user))
-    except RuntimeError:
+    if snapshot is None:
+        try:
+            snapshot = SNAPSHOT_CACHE.get()
+        except RuntimeError:
+            snapshot = None
+    if snapshot is None:
         return "No logged in users users found"
+    (users, totals) = (snapshot.users, snapshot.totals)
+    html = ["<h3>SPY.PY</h3><br>\n"]
     for u in users:
-        html += f"{u.name}/{u.group}<br>\n"
-        html += f"tagline: {u.get('tagline')}<br>\n"
-        html += f"host: ({u.get('host')})<br>\n"
-        html += f"status: {u.fmt_status}<br><br>\n\n"
-    html += "<hr><br>\n"
-    html += f"currently {str(User.onlineusers)} users of {MAXUSERS} users online<br>\n"
-    html += f"up: {User.uploads} {conv_speed(User.total_up_speed)}, "
-    html += f"down: {User.downloads} {conv_speed(User.total_dn_speed)}, "
-    html += f"total: {User.total} {conv_speed(User.total_speed)}<br>\n"
-    html += f"{str(User.browsers)} browser(s), {str(User.idlers)} idler(s)<br>\n"
-    return html
+        html.append(
+            f"{u.name}/{u.group}{'@' + u.site.name if len(SITES) > 1 else ''}<br>\n"
+            f"tagline: {u.get('tagline')}<br>\n"
+            f"host: ({u.get('host')})<br>\n"
+            f"status: {u.fmt_status}<br><br>\n\n"
+        )
+    html.append(
+        "<hr><br>\n"
+        f"currently {str(totals.onlineusers)} users of {get_totalusers()} users online<br>\n"
+        f"up: {totals.uploads} {conv_speed(totals.total_up_speed)}, "
+        f"down: {totals.downloads} {conv_speed(totals.total_dn_speed)}, "
+        f"total: {totals.total} {conv_speed(totals.total_speed)}<br>\n"
+        f"{str(totals.browsers)} browser(s), {str(totals.idlers)} idler(s)<br>\n"
+    )
+    if len(SITES) > 1:
+        for name, site_totals in (snapshot.sites or {}).items():
+            html.append(
+                f"{name}: {site_totals.onlineusers} of {get_totalusers(SITES_BY_NAME.get(name))} online, "
+                f"up: {site_totals.uploads} {conv_speed(site_totals.total_up_speed)}, "
+                f"down: {site_totals.downloads} {conv_speed(site_totals.total_dn_speed)}, "
+                f"{site_totals.browsers} browser(s), {site_totals.idlers} idler(s)<br>\n"
+            )
+    return "".join(html)
+
+
+def get_not_modified(if_none_match, version=None) -> str:
+    """ etag of snapshot version (default: current one) if it matches If-None-Match
+        header, else None. the gzip variant (see Handler.send_body) matches too and
+        is returned as sent """
+    if version is None:
+        version = SNAPSHOT_CACHE.peek_version()
+    if version is None or not if_none_match:
+        return None
+    etag = f'"{SNAPSHOT_CACHE.get_etag(version)}"'
+    if if_none_match.strip() == '*':
+        return etag
+    for tag in if_none_match.split(','):
+        if tag.strip() in [etag, f'{etag[:-1]}-gz"']:
+            return tag.strip()
+    return None
+
+
+def get_api_snapshot(if_none_match=None, since=None, args=None) -> tuple:
+    """ return (status, headers, body) for /api/snapshot, 304 on matching etag
+        is answered from current version without building or encoding a snapshot.
+        with since=<version> only changes since that version are sent, with view
+        args (see get_view) only the selected users """
+    headers = {'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
+    etag = get_not_modified(if_none_match)
+    if etag:
+        headers['ETag'] = etag
+        return (304, headers, b'')
+    try:
+        snapshot = SNAPSHOT_CACHE.get()
+    except RuntimeError as err:
+        return (503, headers, json.dumps(dict(error=str(err))).encode())
+    # without sampler a stale snapshot is only rebuilt by get(), check again
+    etag = get_not_modified(if_none_match, snapshot.version)
+    if etag:
+        headers['ETag'] = etag
+        return (304, headers, b'')
+    headers['ETag'] = f'"{SNAPSHOT_CACHE.get_etag(snapshot.version)}"'
+    if args and set(args) & {'sort_attr', 'sort_rev', 'uniq_attr', 'search', 'offset', 'limit'}:
+        return (200, headers, SNAPSHOT_API.get_view(snapshot, get_view(args)))
+    since = SNAPSHOT_API.parse_since(since) if since else None
+    return (200, headers, SNAPSHOT_API.get(snapshot, since))
+
+
+def get_api_history(args) -> tuple:
+    """ return (status, headers, body) for /api/history: recorded snapshots with
+        start <= time < end (unix time), at most the newest 'limit' of them """
+    headers = {'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
+    if RECORD_READER is None:
+        return (404, headers, json.dumps(dict(error='No record_file found')).encode())
+    try:
+        start = float(args['start']) if args.get('start') else None
+        end = float(args['end']) if args.get('end') else None
+        limit = min(max(int(args.get('limit') or 1000), 1), 100000)
+    except ValueError as err:
+        return (400, headers, json.dumps(dict(error=str(err))).encode())
+    records = [
+        dict(record._asdict(), sessions=[session._asdict() for session in record.sessions])
+        for record in RECORD_READER.get_range(start, end, limit)
+    ]
+    return (200, headers, json.dumps(dict(capacity=RECORD_READER.capacity, records=records), separators=(',', ':')).encode())
 
 
 def create_app() -> object:
@@ -1337,7 +3165,6 @@ def create_app() -> object:
             if not os.path.isdir(static_path):
                 static_path = os.path.join(BUNDLE_DIR, 'webspy/static/')
         app = flask.Flask(__name__, template_folder=tmpl_path, static_folder=static_path, static_url_path='/static')
-        app.secret_key = 'SECRET_KEY'
         if FLASK_PROXY:
             app.wsgi_app = ProxyFix(
                 app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1
@@ -1353,58 +3180,127 @@ def create_app() -> object:
             response = flask.make_response(flask.render_template("js/spy.js"))
             response.headers['Content-Type'] = "text/javascript"
             return response
-        @app.route('/users', defaults={'route': 'users'})
-        @app.route('/totals', defaults={'route': 'totals'})
-        @app.route('/spy', defaults={'route': 'spy'})
-        def webspy(route):
-            users = []
-            err = None
-            total_up_speed = total_dn_speed = total_speed = 0
-            total_up_unit = total_dn_unit = total_unit = ""
-            for i in ['idlers', 'browsers', 'uploads', 'downloads', 'total', 'total_up_speed', 'total_dn_speed', 'total_speed', 'onlineusers']:
-                flask.session[i] = 0
-            try:
-                for user in get_users():
-                    users.append(set_stats(user))
-                flask.session['onlineusers'] = len(users)
-                total_up_speed, total_up_unit = conv_speed(flask.session.get('total_up_speed'))
-                total_dn_speed, total_dn_unit = conv_speed(flask.session.get('total_dn_speed'))
-                total_speed, total_unit = conv_speed(flask.session.get('total_speed'))
-            except RuntimeError:
-                users = None
-                err = "No logged in users users found"
-            sort_attr = flask.request.args.get('sort_attr', default='username', type=str)
-            if flask.request.args.get('sort_attr') == '' and bool(flask.request.args.get('sort_rev')):
-                sort_attr = 'name'
+        def get_fragment(route, args, snapshot=None, err=None) -> str:
+            """ render_webspy() once per snapshot version and view, totals dont depend on view """
+            key = (snapshot.version if snapshot else -1, route)
+            if route == 'totals':
+                args = {}
+            else:
+                key += tuple(get_view(args).values())
+            return FRAGMENT_CACHE.get(key, lambda: render_webspy(route, args, snapshot, err))
+        def render_webspy(route, args, snapshot=None, err=None) -> str:
+            """ render users, totals or spy template for snapshot and query args """
+            view = get_view(args)
+            (users, matched) = USER_QUERY.query(snapshot, **view) if snapshot else (None, 0)
+            totals = snapshot.totals if snapshot else Totals()
+            total_up_speed, total_up_unit = conv_speed(totals.total_up_speed)
+            total_dn_speed, total_dn_unit = conv_speed(totals.total_dn_speed)
+            total_speed, total_unit = conv_speed(totals.total_speed)
+            # per site totals, only with multiple sites
+            sites = [
+                dict(
+                    site_totals._asdict(),
+                    name = name,
+                    totalusers = get_totalusers(SITES_BY_NAME.get(name)),
+                    up_speed = '{}{}'.format(*conv_speed(site_totals.total_up_speed)),
+                    dn_speed = '{}{}'.format(*conv_speed(site_totals.total_dn_speed)),
+                )
+                for name, site_totals in (snapshot.sites or {}).items()
+            ] if snapshot and len(SITES) > 1 else []
             return flask.render_template(
-                # f'{flask.request.path}.html',
                 f'{route}.html',
                 users = users,
+                matched = matched,
+                offset = view['offset'],
+                limit = view['limit'],
+                args = dict(args.items()),
                 glftpd_version = GL_VER,
                 spy_version = SPY_VERSTR,
-                totalusers = TOTALUSERS,
-                sort_attr = sort_attr,
-                sort_rev = flask.request.args.get('sort_rev', default=False, type=bool),
-                uniq_attr = flask.request.args.get('uniq_attr', default=None, type=str),
-                search = flask.request.args.get('search', default=None, type=str),
-                uploads = flask.session.get('uploads'),
-                downloads = flask.session.get('downloads'),
-                total = flask.session.get('uploads') +  flask.session.get('downloads'),
+                totalusers = get_totalusers(),
+                sort_attr = view['sort_attr'],
+                sort_rev = view['sort_rev'],
+                uniq_attr = view['uniq_attr'],
+                search = view['search'],
+                uploads = totals.uploads,
+                downloads = totals.downloads,
+                total = totals.total,
                 total_up_speed = total_up_speed,
                 total_dn_speed = total_dn_speed,
                 total_speed = total_speed,
                 total_up_unit = total_up_unit,
                 total_dn_unit = total_dn_unit,
                 total_unit = total_unit,
-                idlers = flask.session.get('idlers'),
-                browsers = flask.session.get('browsers'),
-                onlineusers = flask.session.get('onlineusers'),
+                idlers = totals.idlers,
+                browsers = totals.browsers,
+                onlineusers = totals.onlineusers,
+                sites = sites,
                 curdate = datetime.datetime.now().strftime("%F %T"),
                 error = err
             )
+        @app.route('/users', defaults={'route': 'users'})
+        @app.route('/totals', defaults={'route': 'totals'})
+        @app.route('/spy', defaults={'route': 'spy'})
+        def webspy(route):
+            try:
+                snapshot = SNAPSHOT_CACHE.get()
+            except RuntimeError:
+                return get_fragment(route, flask.request.args, err="No logged in users users found")
+            return get_fragment(route, flask.request.args, snapshot)
+        @app.route('/events')
+        def events():
+            # same args render the same fragments, share them between subscribers
+            args = flask.request.args.copy()
+            key = tuple(sorted(args.items(multi=True)))
+            def render(snapshot):
+                err = None if snapshot else "No logged in users users found"
+                return {
+                    'users': get_fragment('users', args, snapshot, err),
+                    'totals': get_fragment('totals', args, snapshot, err),
+                }
+            response = flask.Response(
+                flask.stream_with_context(EVENT_BROKER.stream(key, render)),
+                mimetype='text/event-stream'
+            )
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+        @app.route('/api/snapshot')
+        def api_snapshot():
+            (status, headers, body) = get_api_snapshot(
+                flask.request.headers.get('If-None-Match'),
+                flask.request.args.get('since'),
+                flask.request.args
+            )
+            return flask.Response(body, status=status, headers=headers)
+        @app.route('/metrics')
+        def metrics():
+            return flask.Response(METRICS_EXPORTER.get(), headers={'Content-Type': MetricsExporter.content_type})
+        @app.route('/api/history')
+        def api_history():
+            (status, headers, body) = get_api_history(flask.request.args)
+            return flask.Response(body, status=status, headers=headers)
+        @app.route('/api/events')
+        def api_events():
+            since = flask.request.headers.get('Last-Event-ID') or flask.request.args.get('since')
+            response = flask.Response(
+                SNAPSHOT_API.stream(SNAPSHOT_API.parse_since(since) if since else None),
+                mimetype='text/event-stream'
+            )
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+        if DEBUG > 0:
+            @app.route('/debug/stats')
+            def debug_stats():
+                return {
+                    'fragments': FRAGMENT_CACHE.get_stats(),
+                    'userfiles': {site.name: site.userfile_cache.stats for site in SITES},
+                    'filesizes': FILESIZE_CACHE.stats,
+                    'resolver': HOST_RESOLVER.get_stats(),
+                }
         @app.route('/user/<username>')
         def user(username):
-            r = get_userfile(username)
+            r = get_userfile(username, SITES_BY_NAME.get(flask.request.args.get('site')))
             status = r.get('status')
             if status == "Success":
                 return r.get('result'), 200
@@ -1415,7 +3311,7 @@ def create_app() -> object:
             return ["Unknown"], 500
         @app.route('/kick/<username>')
         def kick(username):
-            r = kill_procid(username, get_users())
+            r = kill_procid(username, SNAPSHOT_CACHE.get().users, SITES_BY_NAME.get(flask.request.args.get('site')))
             status = r.get('status')
             print(status)
             if status == "Success":
@@ -1435,7 +3331,14 @@ def create_app() -> object:
 #######
 
 def main():
-    """ start flask, http.server or cli (default) """
+    """ start sampler and recorder, then flask, http.server, recorder or cli (default) """
+    if USERFILE_INDEX:
+        for site in SITES:
+            UserfileIndexThread(site.userfile_cache, USERFILE_INDEX).start()
+    if SAMPLE_RATE:
+        SamplerThread(SNAPSHOT_CACHE, SAMPLE_RATE).start()
+    if RECORDER and not RECORD_MODE:
+        RecorderThread(SNAPSHOT_CACHE, RECORDER, RECORD_INTERVAL).start()
     if APP:
         APP.run(**FLASK_OPTIONS)
     elif _WITH_HTTPD and HTTPD_MODE == 1:
@@ -1450,8 +3353,22 @@ def main():
             raise
         finally:
             sys.exit(0)
+    elif RECORD_MODE == 1:
+        print(f'Recording to {RECORD_FILE} every {RECORD_INTERVAL}s, keeping last {RECORD_MAX} records')
+        try:
+            RecorderThread(SNAPSHOT_CACHE, RECORDER, RECORD_INTERVAL).run()
+        except KeyboardInterrupt:
+            print('RECORD mode exiting...')
+        finally:
+            RECORDER.close()
+            for site in SITES:
+                site.shm_reader.detach()
+            sys.exit(0)
     else:
-        cli_mainloop()
+        try:
+            cli_mainloop()
+        finally:
+            cli_stty_sane()
 
 if _WITH_FLASK and FLASK_MODE == 1:
     APP = create_app()
@@ -3,12 +3,14 @@
 // this is a flask template so url_users and url_totals get set
 
 var timeout_id
+var event_source
 const debug = false;
 const div_users = document.getElementById("include_spy_users");
 const div_totals = document.getElementById("include_spy_totals");
 const div_response = document.getElementById("spy_api_result");
 const url_users = {{ url_for('webspy', route='users') | tojson }};
 const url_totals = {{ url_for('webspy', route='totals') | tojson }};
+const url_events = {{ url_for('events') | tojson }};
 
 // stop refreshing
 
@@ -18,6 +20,9 @@ function set_norefresh(delay_ms = 6000) {
     }
     setTimeout(() => {
         clearTimeout(timeout_id)
+        if (event_source) {
+            event_source.close();
+        }
         if (document.getElementById('show_info')) {
             document.getElementById('show_info').innerText = ('autorefresh: off (reload page to re-enable)');
         }
@@ -26,8 +31,8 @@ function set_norefresh(delay_ms = 6000) {
 
 // user: show, kick, ...
 
-function api_call(endpoint, username) {
-    fetch(encodeURI(`${endpoint}/${username}`), {
+function api_call(endpoint, username, site) {
+    fetch(encodeURI(`${endpoint}/${username}`) + (site ? `?site=${encodeURIComponent(site)}` : ''), {
         method: "GET",
     })
     .then(response => response.json())
@@ -57,9 +62,9 @@ if (el && p == "") {
     el.checked = true;
 }
 
-// main refresh div loop
+// main refresh div loop, used if server-sent events are not available
 
-(function loop() {
+function loop() {
     timeout_id = window.setTimeout(() => {
         let spy_params = new URLSearchParams(window.location.search);
         fetch(encodeURI(`${url_users}?${spy_params}`), {
@@ -78,7 +83,31 @@ if (el && p == "") {
         })
         loop()
     }, 1000);
-})()
+}
+
+// server pushes users and totals only when they changed
+
+if (window.EventSource) {
+    let opened = false;
+    event_source = new EventSource(encodeURI(`${url_events}?${spy_params}`));
+    event_source.onopen = () => {
+        opened = true;
+    };
+    event_source.addEventListener('update', (e) => {
+        let data = JSON.parse(e.data);
+        div_users.innerHTML = data.users;
+        div_totals.innerHTML = data.totals;
+    });
+    // browser reconnects by itself, unless endpoint was never reachable
+    event_source.onerror = () => {
+        if (!opened) {
+            event_source.close();
+            loop();
+        }
+    };
+} else {
+    loop();
+}
 
 if (debug) {
     console.log(`post loop timeout_id=${timeout_id}`)